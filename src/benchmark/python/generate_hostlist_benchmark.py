@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the phases of generating a genders file on synthetic hiera data.
+
+A hiera tree with the requested number of hostfiles is generated for every size. The hostfiles
+are spread over several sources (directories) and domains and vary in size from a few scalar
+attributes to large nested hashes. Discovery, hostname parsing, YAML loading, rendering,
+sorting and writing are timed separately.
+
+With --micro, rendering the entries is also timed in isolation: the former regex based
+sanitizing (render_reference), the memoized renderer host by host (render_memoized) and as one
+batch (render_batch). Finding the domain of every hostname is timed with the former endswith scan
+(match_reference) and the DomainMatcher (match_domains), once with the configured domains and
+once with 30 domains (match_reference_30, match_domains_30).
+
+The results are written as JSON. Given the results of an earlier run as baseline, the benchmark
+fails if any phase got slower than the allowed tolerance.
+
+Example:
+    python src/benchmark/python/generate_hostlist_benchmark.py --sizes 1000 10000 \\
+        --output results.json --baseline previous.json --tolerance 0.2
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from os import makedirs
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, join(dirname(dirname(dirname(abspath(__file__)))), 'main', 'python'))
+
+from generate_hostlist import (AttributeRenderer, DomainMatcher, GenerateGenders,  # noqa: E402
+                               render_gender_entry, sort_entries)
+
+DOMAINS = {
+    'fg.stage00.eu.example.com':
+        r'^(?P<hostgroup>.*?)[0-9]+\.(?P<team>[^.]*)\.stage(?P<stage>[0-9]+)\.(?P<dc>[^.]*)\.',
+    'ops.example.net': r'^(?P<hostgroup>.*?)-?[0-9]+\.(?P<team>[^.]*)\.example\.net$',
+    'lab.example.org': r'^(?P<hostgroup>[a-z]+)(?P<number>[0-9]+)\.lab\.example\.org$',
+}
+HOSTNAMES = [
+    '{role}{number:06d}.fg.stage00.eu.example.com',
+    '{role}-{number:06d}.ops.example.net',
+    '{role}{number:06d}.lab.example.org',
+]
+ROLES = ['web', 'db', 'mail', 'compute', 'proxy', 'cache', 'search', 'batch']
+SOURCES = ['prod', 'stage', 'lab']
+PHASES = ['discovery', 'hostname_parsing', 'yaml_loading', 'rendering', 'sorting', 'writing']
+MANY_DOMAINS = dict(DOMAINS, **dict(
+    ('zone%02d.example.net' % zone, r'^(?P<hostgroup>[a-z]+)') for zone in range(27)))
+MICRO_PHASES = ['render_reference', 'render_memoized', 'render_batch',
+                'match_reference', 'match_domains', 'match_reference_30', 'match_domains_30']
+
+
+def generate_hiera_tree(directory, size, seed=42):
+    """Write size synthetic hostfiles into subdirectories (sources) of directory.
+
+    Returns:
+        A dict of source names and directories as expected by GenerateGenders
+    """
+    rand = random.Random(seed)
+    inputdirectories = {}
+    for source in SOURCES:
+        inputdirectories[source] = join(directory, source)
+        makedirs(inputdirectories[source])
+    for number in range(size):
+        role = rand.choice(ROLES)
+        hostname = rand.choice(HOSTNAMES).format(role=role, number=number)
+        lines = [
+            "---",
+            "role: '%s'" % role,
+            "stage: 'stage%s'" % rand.randint(0, 3),
+            "contact: '%s-team@example.com'" % role,
+            "comment: 'Synthetic host number %s'" % number,
+            "kostenstelle: %s" % rand.randint(1000, 9999),
+        ]
+        kind = rand.random()
+        if kind > 0.7:
+            lines.append("packages:")
+            lines.extend("  - 'package%s'" % package for package in range(rand.randint(5, 50)))
+        if kind > 0.95:
+            lines.append("certificate: |")
+            lines.extend("  %064x" % rand.getrandbits(256) for _ in range(rand.randint(20, 60)))
+            lines.append("settings:")
+            for section in range(rand.randint(3, 10)):
+                lines.append("  section%s:" % section)
+                lines.extend("    key%s: 'value%s'" % (key, key) for key in range(10))
+        source = SOURCES[number % len(SOURCES)]
+        with open(join(inputdirectories[source], hostname + '.yaml'), 'w') as hostfile:
+            hostfile.write("\n".join(lines) + "\n")
+    return inputdirectories
+
+
+def timed(results, phase, function, *args):
+    """Call function, store its runtime in results[phase] and return its result."""
+    start = time.time()
+    result = function(*args)
+    results[phase] = time.time() - start
+    return result
+
+
+def run_benchmark(size, yaml_backend, workdir=None):
+    """Return the runtime of every phase for a synthetic tree of size hostfiles."""
+    directory = tempfile.mkdtemp(prefix='genders_benchmark', dir=workdir)
+    try:
+        generator = GenerateGenders(
+            inputdirectories=generate_hiera_tree(directory, size),
+            gendersfile=join(directory, 'genders'),
+            domainconfig=DOMAINS,
+            verbosity='CRITICAL',
+            yaml_backend=yaml_backend
+        )
+        results = {}
+        host_tasks = timed(results, 'discovery', generator.get_host_tasks)
+        attributes = timed(results, 'hostname_parsing', generator.classify_hostnames,
+                           [host_task.hostname for host_task in host_tasks])
+        file_configs = timed(results, 'yaml_loading', lambda: [
+            generator.get_config_from_file(join(host_task.directory_path, host_task.filename))
+            for host_task in host_tasks
+        ])
+
+        def render():
+            """Render the entries of all hosts."""
+            entries = []
+            for (host_task, file_config) in zip(host_tasks, file_configs):
+                config = dict(attributes[host_task.hostname])
+                config.update(file_config)
+                entries.append(render_gender_entry(host_task.hostname,
+                                                   host_task.directory_name,
+                                                   config))
+            return entries
+        entries = timed(results, 'rendering', render)
+        sorted_entries = timed(results, 'sorting', lambda: list(
+            sort_entries(entries, generator.sort_buffer_size, directory)))
+        timed(results, 'writing', generator.write_genders_file, sorted_entries)
+        results['total'] = sum(results[phase] for phase in PHASES)
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def generate_host_attributes(size, seed=42):
+    """Return size (hostname, source, attributes) tuples like the parsed synthetic hostfiles."""
+    rand = random.Random(seed)
+    hosts = []
+    for number in range(size):
+        role = rand.choice(ROLES)
+        attributes = {
+            'hostgroup': role,
+            'role': role,
+            'stage': 'stage%s' % rand.randint(0, 3),
+            'contact': '%s-team@example.com' % role,
+            'comment': 'Synthetic host number %s' % number,
+            'kostenstelle': rand.randint(1000, 9999),
+        }
+        if rand.random() > 0.7:
+            attributes['packages'] = ['package%s' % package
+                                      for package in range(rand.randint(5, 50))]
+        hosts.append((rand.choice(HOSTNAMES).format(role=role, number=number),
+                      SOURCES[number % len(SOURCES)],
+                      attributes))
+    return hosts
+
+
+def render_reference(hostname, source, attributes):
+    """Render an entry like generate_hostlist did before the AttributeRenderer."""
+    config_list = ["source=%s" % (source)]
+    for (key, value) in attributes.items():
+        value = re.sub(r"[ #,=]", "_", unicode(value))
+        config_list.append('%s=%s' % (key, value))
+    config_list.sort()
+    return u"{}\t{}".format(hostname, ",".join(config_list))
+
+
+def run_render_benchmark(size):
+    """Return the runtime of rendering size hosts with the reference and the current renderer."""
+    hosts = generate_host_attributes(size)
+    results = {}
+    timed(results, 'render_reference', lambda: [render_reference(*host) for host in hosts])
+    renderer = AttributeRenderer()
+    timed(results, 'render_memoized', lambda: [
+        u"%s\t%s" % (hostname, renderer.render_attributes(source, attributes))
+        for (hostname, source, attributes) in hosts])
+    timed(results, 'render_batch', AttributeRenderer().render_entries, hosts)
+    return results
+
+
+def match_reference(domainconfig, hostname):
+    """Find the domain of hostname like generate_hostlist did before the DomainMatcher."""
+    for domain in domainconfig.keys():
+        if hostname.endswith(domain):
+            return (domain, re.compile(domainconfig[domain]))
+    return None
+
+
+def run_match_benchmark(size):
+    """Return the runtime of finding the domains of size hostnames with and without an index."""
+    hostnames = [hostname for (hostname, _, _) in generate_host_attributes(size)]
+    results = {}
+    for (suffix, domainconfig) in [('', DOMAINS), ('_30', MANY_DOMAINS)]:
+        timed(results, 'match_reference' + suffix, lambda: [
+            match_reference(domainconfig, hostname) for hostname in hostnames])
+        match = DomainMatcher(domainconfig).match
+        timed(results, 'match_domains' + suffix, lambda: [match(hostname)
+                                                          for hostname in hostnames])
+    return results
+
+
+def find_regressions(results, baseline, tolerance, minimum):
+    """Return a list of messages for all phases slower than the baseline.
+
+    Phases are only compared if both runtimes are at least minimum seconds, to skip noise.
+    """
+    regressions = []
+    for (size, phases) in sorted(results['results'].items()):
+        for (phase, runtime) in sorted(phases.items()):
+            previous = baseline.get('results', {}).get(size, {}).get(phase)
+            if previous is None or max(runtime, previous) < minimum:
+                continue
+            if runtime > previous * (1 + tolerance):
+                regressions.append("%s hosts, %s: %.3fs -> %.3fs (+%.0f%%)" % (
+                    size, phase, previous, runtime, (runtime / previous - 1) * 100))
+    return regressions
+
+
+def __parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes",
+                        help="Number of hostfiles to benchmark (1000 10000)",
+                        nargs='+',
+                        type=int,
+                        default=[1000, 10000],
+                        )
+    parser.add_argument("--yaml-backend",
+                        help="YAML backend of the generator (yamlreader)",
+                        default='yamlreader',
+                        )
+    parser.add_argument("--micro",
+                        help="Also run the rendering and domain matching micro-benchmarks",
+                        action='store_true',
+                        )
+    parser.add_argument("--workdir",
+                        help="Generate the hiera trees in this directory",
+                        )
+    parser.add_argument("-o",
+                        "--output",
+                        help="Write the results as JSON to this file",
+                        )
+    parser.add_argument("-b",
+                        "--baseline",
+                        help="Fail if a phase is slower than in these results",
+                        )
+    parser.add_argument("-t",
+                        "--tolerance",
+                        help="Allowed slowdown against the baseline (0.2 = 20%%)",
+                        type=float,
+                        default=0.2,
+                        )
+    parser.add_argument("--minimum",
+                        help="Ignore phases faster than this many seconds (0.05)",
+                        type=float,
+                        default=0.05,
+                        )
+    return parser.parse_args()
+
+
+def __main():
+    args = __parse_args()
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'yaml_backend': args.yaml_backend,
+        'timestamp': time.time(),
+        'results': {},
+    }
+    for size in args.sizes:
+        results['results'][str(size)] = run_benchmark(size, args.yaml_backend, args.workdir)
+        phases = PHASES + ['total']
+        if args.micro:
+            results['results'][str(size)].update(run_render_benchmark(size))
+            results['results'][str(size)].update(run_match_benchmark(size))
+            phases += MICRO_PHASES
+        print("%8s hosts: %s" % (size, ", ".join(
+            "%s %.3fs" % (phase, results['results'][str(size)][phase]) for phase in phases)))
+    if args.output:
+        with open(args.output, 'w') as outputfile:
+            json.dump(results, outputfile, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as baselinefile:
+            baseline = json.load(baselinefile)
+        regressions = find_regressions(results, baseline, args.tolerance, args.minimum)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    __main()
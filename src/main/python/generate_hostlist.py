@@ -6,11 +6,2169 @@ The hostname is split by a configurable regex into atributes as is the data from
 
 """
 
+import cProfile
+import hashlib
+import heapq
+import io
+import json
 import logging
+import os
 import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from os import listdir
-from os.path import isfile, join
+from os.path import dirname, isdir, isfile, join
+import yaml
 from yamlreader import yaml_load, YamlReaderError
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    _cpu_time = time.clock
+
+HostTask = namedtuple('HostTask', ['directory_name', 'directory_path', 'hostname', 'filename',
+                                   'filestat', 'blob'])
+YAML_BACKENDS = ('auto', 'c', 'python', 'yamlreader')
+LOG_FORMATS = ('text', 'json')
+
+_WORKER = None
+WRITE_BUFFER_SIZE = 1024 * 1024
+SORT_FAN_IN = 64  # Maximum number of sorted runs merged at once by sort_entries
+_ESCAPED_CHARACTERS = re.compile(r'\\(.)')
+_SKIPPED = object()
+
+
+def _escape_entry(entry):
+    """Return entry without newlines to be stored as line of a temporary file."""
+    return entry.replace(u'\\', u'\\\\').replace(u'\n', u'\\n')
+
+
+def _unescape_entry(line):
+    """Return the entry stored by _escape_entry."""
+    def unescape(match):
+        """Return the escaped character."""
+        return u'\n' if match.group(1) == u'n' else match.group(1)
+    return _ESCAPED_CHARACTERS.sub(unescape, line)
+
+
+def _write_sorted_chunk(chunk, tempdir, dump):
+    """Sort chunk and write it to a temporary file, which is returned rewound."""
+    chunk.sort()
+    chunkfile = tempfile.TemporaryFile(dir=tempdir, prefix='.genders_sort')
+    chunkfile.writelines(_escape_entry(dump(entry)).encode('utf-8') + b'\n' for entry in chunk)
+    chunkfile.seek(0)
+    return chunkfile
+
+
+def _read_sorted_chunk(chunkfile, load):
+    """Return an iterator of the entries in a chunkfile and close it when done."""
+    with chunkfile:
+        for line in chunkfile:
+            yield load(_unescape_entry(line[:-1].decode('utf-8')))
+
+
+def _merge_sorted_chunks(chunkfiles, tempdir, dump, load):
+    """Merge chunkfiles into one temporary file, which is returned rewound."""
+    mergedfile = tempfile.TemporaryFile(dir=tempdir, prefix='.genders_sort')
+    entries = heapq.merge(*[_read_sorted_chunk(chunkfile, load) for chunkfile in chunkfiles])
+    mergedfile.writelines(_escape_entry(dump(entry)).encode('utf-8') + b'\n'
+                          for entry in entries)
+    mergedfile.seek(0)
+    return mergedfile
+
+
+def _identity(entry):
+    """Return entry."""
+    return entry
+
+
+def sort_entries(entries, buffer_size, tempdir=None, dump=_identity, load=_identity,
+                 fan_in=SORT_FAN_IN):
+    """Return an iterator of the sorted entries.
+
+    Entries are sorted in memory until their size exceeds buffer_size bytes. Then sorted chunks
+    of this size are written to temporary files and merged while iterating over the result.
+    Whenever fan_in chunks of the same level are written, they are merged into one chunk of the
+    next level, so the number of open temporary files only grows with the logarithm of the
+    number of entries.
+
+    Args:
+        entries (iterable): The (unicode) strings or other sortable objects to sort
+        buffer_size (int):  Maximum size of the entries held in memory. None for no limit.
+        tempdir (str):      Directory for the temporary files. Default: system default
+        dump (function):    Convert an entry to a unicode string for the temporary files
+        load (function):    Convert a string returned by dump back to the entry
+        fan_in (int):       Maximum number of chunks merged at once. Default: SORT_FAN_IN
+    Returns:
+        An iterator of the sorted entries
+    """
+    chunk = []
+    chunk_size = 0
+    levels = [[]]
+
+    def add_chunkfile(chunkfile, level=0):
+        """Add a chunkfile to a level, merging the level into the next one when it is full."""
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(chunkfile)
+        if len(levels[level]) >= fan_in:
+            chunkfiles = levels[level]
+            levels[level] = []
+            add_chunkfile(_merge_sorted_chunks(chunkfiles, tempdir, dump, load), level + 1)
+    for entry in entries:
+        chunk.append(entry)
+        chunk_size += sys.getsizeof(entry)
+        if buffer_size and chunk_size >= buffer_size:
+            add_chunkfile(_write_sorted_chunk(chunk, tempdir, dump))
+            chunk = []
+            chunk_size = 0
+    chunkfiles = [chunkfile for level in levels for chunkfile in level]
+    if not chunkfiles:
+        chunk.sort()
+        return iter(chunk)
+    if chunk:
+        chunkfiles.insert(0, _write_sorted_chunk(chunk, tempdir, dump))
+    if len(chunkfiles) > fan_in:
+        # Merge the smallest chunks, so at most fan_in chunks are read at the same time
+        excess = len(chunkfiles) - fan_in + 1
+        chunkfiles[:excess] = [_merge_sorted_chunks(chunkfiles[:excess], tempdir, dump, load)]
+    return heapq.merge(*[_read_sorted_chunk(chunkfile, load) for chunkfile in chunkfiles])
+
+
+def _init_worker(generator):
+    """Make the generator available to the functions run by the worker processes."""
+    global _WORKER  # pylint: disable=global-statement
+    _WORKER = generator
+
+
+def _render_in_worker(prefetched):
+    """Return the result of render_host_task and the stats for a host task."""
+    _WORKER.stats = RunStats(bool(_WORKER.profile))
+    (host_records, log_records, layers) = _WORKER.render_host_task(*prefetched)
+    return host_records, log_records, layers, _WORKER.stats.get_totals()
+
+
+class _LogRecorder(object):
+    """Collect log messages so they can be replayed by the parent process in order.
+
+    Messages are only formatted if they would be emitted by the original logger.
+    """
+
+    def __init__(self, logger):
+        self.level = logger.getEffectiveLevel()
+        self.records = []
+
+    def isEnabledFor(self, level):  # noqa: N802 (same interface as logging.Logger)
+        """Return whether messages of level are recorded."""
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        """Record message if it would be emitted by the original logger."""
+        if level >= self.level:
+            self.records.append((level, message % args if args else message))
+
+    def debug(self, message, *args):
+        """Record debug message."""
+        self.log(logging.DEBUG, message, *args)
+
+    def info(self, message, *args):
+        """Record info message."""
+        self.log(logging.INFO, message, *args)
+
+    def warning(self, message, *args):
+        """Record warning message."""
+        self.log(logging.WARNING, message, *args)
+
+    def critical(self, message, *args):
+        """Record critical message."""
+        self.log(logging.CRITICAL, message, *args)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as one JSON object per line."""
+
+    def format(self, record):
+        """Return the record as JSON with time, level, logger and message."""
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True)
+
+
+def get_logger(verbosity='WARNING', log_format='text'):
+    """Return the logger of this module writing to stderr.
+
+    The stream handler is only added once, so creating several GenerateGenders (e.g. in a long
+    running service) does not duplicate the log messages. Every call sets the level and the
+    format of the shared logger.
+
+    Args:
+        verbosity (str):  Loglevel. Allowed Keywords: DEBUG, INFO, WARNING, CRITICAL
+        log_format (str): 'text' ("LEVEL:message") or 'json' (one JSON object per line)
+    Returns:
+        the logger
+    """
+    if log_format not in LOG_FORMATS:
+        raise ValueError("Unknown log format '%s', use one of %s" % (
+            log_format, ", ".join(LOG_FORMATS)))
+    logger = logging.getLogger(__name__)
+    logger.setLevel(getattr(logging, verbosity, 30))
+    handlers = [handler for handler in logger.handlers
+                if getattr(handler, 'generate_hostlist', False)]
+    if handlers:
+        console_logger = handlers[0]
+    else:
+        console_logger = logging.StreamHandler()
+        console_logger.generate_hostlist = True
+        logger.addHandler(console_logger)
+    if log_format == 'json':
+        console_logger.setFormatter(JsonLogFormatter())
+    else:
+        console_logger.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+    return logger
+
+
+class ReadOnlyDict(dict):
+    """A dict which cannot be changed, used for parsed data shared by several hosts.
+
+    Only the top level is read-only, nested values are shared as they are.
+    """
+
+    def __readonly(self, *args, **kwargs):
+        """Raise a TypeError, the dict cannot be changed."""
+        raise TypeError("Shared parsed data cannot be changed, copy it first")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __readonly
+
+    def __reduce__(self):
+        """Pickle and copy the dict without calling __setitem__."""
+        return (ReadOnlyDict, (dict(self),))
+
+
+def read_file(filename):
+    """Return the content of a file as bytes or None if it cannot be read."""
+    try:
+        with open(filename, 'rb') as filehandler:
+            return filehandler.read()
+    except (IOError, OSError):
+        return None
+
+
+def load_yaml_file(filename, loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader), content=None,
+                   projection=None):
+    """Return the content of a YAML file.
+
+    Errors are raised as YamlReaderError with the same messages as yamlreader.yaml_load uses.
+
+    Args:
+        filename (str):                   a filename (with path) to read
+        loader (class):                   the yaml Loader to parse the file with
+        content (bytes):                  the already read content of the file.
+                                          Default: None (read the file)
+        projection (AttributeProjection): only construct the projected attributes.
+                                          Default: None (the whole document)
+    Returns:
+        the parsed content
+    """
+    if content is None:
+        content = read_file(filename)
+        if content is None:
+            raise YamlReaderError("No YAML data found in %s" % filename)
+    yamlfilehandler = io.BytesIO(content)
+    yamlfilehandler.name = filename  # used in the error messages of the parser
+    try:
+        if projection is not None:
+            return projection.load_yaml(yamlfilehandler, loader)
+        return yaml.load(yamlfilehandler, Loader=loader)
+    except yaml.YAMLError as exc:
+        raise YamlReaderError("YAML Error: %s" % exc)
+
+
+def load_json_file(filename, content=None, projection=None):
+    """Return the content of a JSON file.
+
+    Errors are raised as YamlReaderError like in load_yaml_file. The projection is applied
+    after parsing (see AttributeProjection.apply).
+    """
+    if content is None:
+        content = read_file(filename)
+        if content is None:
+            raise YamlReaderError("No JSON data found in %s" % filename)
+    try:
+        data = json.loads(content.decode('utf-8'))
+    except ValueError as exc:
+        raise YamlReaderError("JSON Error: %s" % exc)
+    if projection is not None:
+        return projection.apply(data)
+    return data
+
+
+class AttributeProjection(object):
+    """Select the attributes of the hostfiles used for the genders file.
+
+    Unwanted top level keys and collections nested deeper than max_depth are skipped while
+    reading the events of the YAML parser, so their nodes and objects are never constructed.
+    With a max_depth of 0 only scalar attributes are kept, with 1 also lists and hashes of
+    scalars, and so on. Keys are matched against the include and exclude globs.
+
+    Args:
+        include (list):  Only keep attributes matching one of these globs. Default: None (all)
+        exclude (list):  Skip attributes matching one of these globs. Default: None
+        max_depth (int): Skip collections nested deeper. Default: None (no limit)
+    """
+
+    def __init__(self, include=None, exclude=None, max_depth=None):
+        """See Class docstring."""
+        self.include = include or []
+        self.exclude = exclude or []
+        self.max_depth = max_depth
+
+    def keep_key(self, key):
+        """Return True if the top level key is projected."""
+        if not isinstance(key, (str, unicode)):
+            key = unicode(key)
+        if self.include and not any(fnmatch(key, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch(key, pattern) for pattern in self.exclude)
+
+    def apply(self, data):
+        """Return the projection of already parsed data (e.g. of a JSON file)."""
+        if not isinstance(data, dict):
+            return self.__apply(data, 0)
+        return dict((key, value) for (key, value) in (
+            (key, self.__apply(value, 1)) for (key, value) in data.items() if self.keep_key(key))
+            if value is not _SKIPPED)
+
+    def __apply(self, data, depth):
+        """Return the projection of a value or _SKIPPED if it is nested too deep."""
+        if not isinstance(data, (dict, list)):
+            return data
+        if self.max_depth is not None and depth > self.max_depth:
+            return _SKIPPED
+        if isinstance(data, dict):
+            return dict((key, value) for (key, value) in (
+                (key, self.__apply(value, depth + 1)) for (key, value) in data.items())
+                if value is not _SKIPPED)
+        return [item for item in (self.__apply(item, depth + 1) for item in data)
+                if item is not _SKIPPED]
+
+    def load_yaml(self, stream, loader):
+        """Return the projection of a YAML document.
+
+        Args:
+            stream (file): The YAML document
+            loader (class): The yaml Loader to parse the stream with
+        Returns:
+            the constructed data
+        """
+        loader = loader(stream)
+        try:
+            loader.get_event()  # StreamStartEvent
+            if loader.check_event(yaml.StreamEndEvent):
+                return None
+            loader.get_event()  # DocumentStartEvent
+            anchors = {}
+            if loader.check_event(yaml.MappingStartEvent):
+                node = self.__compose_root(loader, anchors)
+            else:
+                node = self.__compose_node(loader, anchors, 0)
+            loader.get_event()  # DocumentEndEvent
+            if not loader.check_event(yaml.StreamEndEvent):
+                raise yaml.composer.ComposerError(
+                    "expected a single document in the stream", node.start_mark,
+                    "but found another document", loader.get_event().start_mark)
+            if node is None:
+                return None
+            data = loader.construct_document(node)
+        finally:
+            loader.dispose()
+        # Merge keys ('<<') and aliases to anchored nodes, which are composed completely, can
+        # add data which was not filtered while composing
+        return self.apply(data)
+
+    def __compose_root(self, loader, anchors):
+        """Compose the top level mapping, skipping the values of unwanted keys."""
+        event = loader.get_event()
+        node = yaml.MappingNode(self.__resolve_tag(loader, yaml.MappingNode, event), [],
+                                event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.peek_event()
+            if ((isinstance(key, yaml.ScalarEvent) and key.value != u'<<' and
+                 not self.keep_key(key.value))):
+                self.__skip_node(loader, anchors)
+                self.__skip_node(loader, anchors)
+                continue
+            merge = isinstance(key, yaml.ScalarEvent) and key.value == u'<<'
+            key_node = self.__compose_node(loader, anchors, 1)
+            value_node = self.__compose_node(loader, anchors, None if merge else 1)
+            if key_node is not None and value_node is not None:
+                node.value.append((key_node, value_node))
+        node.end_mark = loader.get_event().end_mark
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        return node
+
+    def __skip_node(self, loader, anchors):
+        """Consume the events of the next node without composing it.
+
+        Anchored nodes are composed anyway, as they can be referenced by later aliases.
+        """
+        level = 0
+        while True:
+            event = loader.peek_event()
+            if ((getattr(event, 'anchor', None) is not None and
+                 not isinstance(event, yaml.AliasEvent))):
+                self.__compose_node(loader, anchors, None)
+            else:
+                loader.get_event()
+                if isinstance(event, (yaml.SequenceStartEvent, yaml.MappingStartEvent)):
+                    level += 1
+                elif isinstance(event, (yaml.SequenceEndEvent, yaml.MappingEndEvent)):
+                    level -= 1
+            if level == 0:
+                return
+
+    def __compose_node(self, loader, anchors, depth):
+        """Compose the next node like yaml.composer.Composer.
+
+        Collections nested deeper than self.max_depth are skipped and None is returned.
+        Anchored nodes are composed completely (depth None).
+        """
+        event = loader.peek_event()
+        if event.anchor is not None and not isinstance(event, yaml.AliasEvent):
+            depth = None
+        child_depth = None if depth is None else depth + 1
+        if isinstance(event, yaml.AliasEvent):
+            loader.get_event()
+            if event.anchor not in anchors:
+                raise yaml.composer.ComposerError(None, None, "found undefined alias %r" % (
+                    event.anchor), event.start_mark)
+            return anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            loader.get_event()
+            node = yaml.ScalarNode(self.__resolve_tag(loader, yaml.ScalarNode, event),
+                                   event.value, event.start_mark, event.end_mark,
+                                   style=event.style)
+        elif depth is not None and self.max_depth is not None and depth > self.max_depth:
+            self.__skip_node(loader, anchors)
+            return None
+        elif isinstance(event, yaml.SequenceStartEvent):
+            loader.get_event()
+            node = yaml.SequenceNode(self.__resolve_tag(loader, yaml.SequenceNode, event), [],
+                                     event.start_mark, None, flow_style=event.flow_style)
+            while not loader.check_event(yaml.SequenceEndEvent):
+                item = self.__compose_node(loader, anchors, child_depth)
+                if item is not None:
+                    node.value.append(item)
+            node.end_mark = loader.get_event().end_mark
+        else:
+            loader.get_event()
+            node = yaml.MappingNode(self.__resolve_tag(loader, yaml.MappingNode, event), [],
+                                    event.start_mark, None, flow_style=event.flow_style)
+            while not loader.check_event(yaml.MappingEndEvent):
+                key_node = self.__compose_node(loader, anchors, child_depth)
+                value_node = self.__compose_node(loader, anchors, child_depth)
+                if key_node is not None and value_node is not None:
+                    node.value.append((key_node, value_node))
+            node.end_mark = loader.get_event().end_mark
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        return node
+
+    @staticmethod
+    def __resolve_tag(loader, kind, event):
+        """Return the explicit or the implicitly resolved tag of the node of an event."""
+        if event.tag is not None and event.tag != u'!':
+            return event.tag
+        if kind is yaml.ScalarNode:
+            return loader.resolve(kind, event.value, event.implicit)
+        return loader.resolve(kind, None, event.implicit)
+
+
+def sanitize_value(value):
+    """Return the unicode string value with ' ', '#', ',' and '=' replaced by '_'.
+
+    Chained str.replace calls are several times faster than re.sub or unicode.translate.
+    """
+    return value.replace(u' ', u'_').replace(u'#', u'_').replace(u',', u'_').replace(u'=', u'_')
+
+
+def _sorted_items(mapping):
+    """Return the items of mapping sorted by key (by the key's repr for unorderable keys)."""
+    try:
+        return sorted(mapping.items())
+    except TypeError:
+        return sorted(mapping.items(), key=lambda item: repr(item[0]))
+
+
+def _repr_value(value):
+    """Return the repr of a value nested in a list or dict (see render_value)."""
+    if isinstance(value, (dict, list)):
+        return render_value(value)
+    return repr(value)
+
+
+def render_value(value):
+    """Return the unicode string of an attribute value.
+
+    Scalars and lists are rendered like unicode() does. Dicts (also nested ones) are rendered
+    like unicode() but with sorted keys, so the entry of a host does not depend on the order
+    of its hash.
+    """
+    if isinstance(value, dict):
+        return u'{%s}' % u', '.join(u'%s: %s' % (_repr_value(key), _repr_value(item))
+                                    for (key, item) in _sorted_items(value))
+    rendered = unicode(value)
+    if isinstance(value, list) and u'{' in rendered:
+        # only lists containing dicts need to be rendered item by item
+        return u'[%s]' % u', '.join(_repr_value(item) for item in value)
+    return rendered
+
+
+class AttributeRenderer(object):
+    """Render the attributes of hosts as used in a genders file.
+
+    Values are converted by render_value and the characters ' ', '#', ',' and '=' replaced by
+    '_'. The rendered 'key=value' pairs of hashable values are memoized, as most values (roles,
+    stages, contacts, ...) are shared by many hosts.
+
+    Args:
+        max_size (int): Maximum number of memoized pairs. The memo is cleared when it is full.
+                        Default: 100000
+    """
+
+    def __init__(self, max_size=100000):
+        """See Class docstring."""
+        self.max_size = max_size
+        self.memo = {}
+
+    def render_attribute(self, key, value):
+        """Return the sanitized 'key=value' pair."""
+        try:
+            memo_key = (key, value.__class__, value)
+            attribute = self.memo.get(memo_key)
+        except TypeError:
+            return u'%s=%s' % (key, sanitize_value(render_value(value)))
+        if attribute is None:
+            attribute = u'%s=%s' % (key, sanitize_value(render_value(value)))
+            if len(self.memo) >= self.max_size:
+                self.memo.clear()
+            self.memo[memo_key] = attribute
+        return attribute
+
+    def render_tokens(self, source, attributes):
+        """Return the sorted 'key=value' pairs of a genders entry.
+
+        Args:
+            source (str):      The name of the source directory, added as source attribute
+            attributes (dict): The attributes of the host
+        Returns:
+            a tuple of all sorted attributes (see HostRecord)
+        """
+        memo = self.memo
+        config_list = [u'source=%s' % source]
+        for (key, value) in attributes.items():
+            try:
+                config_list.append(memo[(key, value.__class__, value)])
+            except (KeyError, TypeError):
+                config_list.append(self.render_attribute(key, value))
+        config_list.sort()
+        return tuple(config_list)
+
+    def render_attributes(self, source, attributes):
+        """Return the attributes of a genders entry.
+
+        Args:
+            source (str):      The name of the source directory, added as source attribute
+            attributes (dict): The attributes of the host
+        Returns:
+            a string of all sorted attributes joined by ','
+        """
+        return u",".join(self.render_tokens(source, attributes))
+
+    def render_entries(self, hosts):
+        """Return the genders entries of many hosts.
+
+        Args:
+            hosts (iterable): (hostname, source, attributes) tuples
+        Returns:
+            a list of the entries in the order of hosts
+        """
+        render_attributes = self.render_attributes
+        return [u"%s\t%s" % (hostname, render_attributes(source, attributes))
+                for (hostname, source, attributes) in hosts]
+
+
+_RENDERER = AttributeRenderer()
+
+
+def render_attributes(source, attributes):
+    """Return the attributes of a genders entry.
+
+    See AttributeRenderer.render_attributes.
+    """
+    return _RENDERER.render_attributes(source, attributes)
+
+
+def render_gender_entries(hosts):
+    """Return the genders entries of many hosts.
+
+    See AttributeRenderer.render_entries.
+    """
+    return _RENDERER.render_entries(hosts)
+
+
+def render_gender_entry(hostname, source, attributes):
+    """Return an entry for a genders file.
+
+    Args:
+        hostname (str):    A string of the hostname
+        source (str):      The name of the source directory, added as source attribute
+        attributes (dict): The attributes of the host
+    Returns:
+        a string containing the hostname and all attributes to be used in a genders file
+    """
+    return u"%s\t%s" % (hostname, render_attributes(source, attributes))
+
+
+class HostRecord(tuple):
+    """A host and its rendered attributes.
+
+    A HostRecord is a (hostname, attributes) tuple, where attributes is a tuple of the sorted
+    'key=value' (or 'key') strings of the host, which are only joined when the entry is
+    rendered. The strings of values shared by many hosts (roles, stages, contacts, ...) are
+    stored once if the records are interned through a SymbolTable. Records are sized as if
+    they did not share any string, as a stream of records does not keep the table.
+    HostRecords sort like the rendered genders entries, as long as hostnames and values contain
+    no characters sorting before ','.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, hostname, attributes):
+        """Return a new HostRecord."""
+        return tuple.__new__(cls, (hostname, attributes))
+
+    def __getnewargs__(self):
+        """Return the arguments for __new__ (used by pickle)."""
+        return tuple(self)
+
+    def __sizeof__(self):
+        """Return the size of the record, its hostname and its attributes."""
+        return (tuple.__sizeof__(self) + sys.getsizeof(self[0]) + sys.getsizeof(self[1]) +
+                sum(map(sys.getsizeof, self[1])))
+
+    @property
+    def hostname(self):
+        """The hostname."""
+        return self[0]
+
+    @property
+    def attributes(self):
+        """The attributes joined by ','."""
+        return u",".join(self[1])
+
+    def render(self):
+        """Return the entry for a genders file."""
+        return u"%s\t%s" % (self[0], u",".join(self[1]))
+
+    @classmethod
+    def parse(cls, gender_entry):
+        """Return the HostRecord of a genders entry."""
+        (hostname, _, attributes) = gender_entry.partition(u'\t')
+        return cls(hostname, tuple(attribute for attribute in attributes.split(u',')
+                                   if attribute))
+
+
+class TargetRecord(tuple):
+    """A HostRecord tagged with the index of its output.
+
+    Output 0 is the genders file, output n the n-th GendersTarget. The records of all outputs
+    can be sorted in one pass grouped by output. The records of shards are tagged with the index
+    of their shard the same way.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, target, host_record):
+        """Return a new TargetRecord."""
+        return tuple.__new__(cls, (target, host_record))
+
+    def __getnewargs__(self):
+        """Return the arguments for __new__ (used by pickle)."""
+        return tuple(self)
+
+    def __sizeof__(self):
+        """Return the size of the record and its HostRecord."""
+        return tuple.__sizeof__(self) + sys.getsizeof(self[1])
+
+    def render(self):
+        """Return the line stored in temporary files while sorting."""
+        return u"%d\t%s" % (self[0], self[1].render())
+
+    @classmethod
+    def parse(cls, line):
+        """Return the TargetRecord of a line returned by render."""
+        (target, _, gender_entry) = line.partition(u'\t')
+        return cls(int(target), HostRecord.parse(gender_entry))
+
+
+def iter_target_streams(target_records, targets):
+    """Return one iterator of HostRecords for each of targets outputs.
+
+    Args:
+        target_records (iterable): TargetRecords sorted by output
+        targets (int):             The number of outputs
+    Returns:
+        A list of iterators, which have to be consumed in order
+    """
+    target_records = iter(target_records)
+    head = [next(target_records, None)]
+
+    def iter_target(target):
+        """Return an iterator of the HostRecords of an output."""
+        while head[0] is not None and head[0][0] < target:
+            head[0] = next(target_records, None)
+        while head[0] is not None and head[0][0] == target:
+            host_record = head[0][1]
+            head[0] = next(target_records, None)
+            yield host_record
+    return [iter_target(target) for target in range(targets)]
+
+
+class SymbolTable(object):
+    """Interned attribute strings shared by HostRecords.
+
+    The 'key=value' strings of the attributes of many hosts (roles, stages, contacts, ...) are
+    stored once and the key of every attribute string is split off only once.
+    Tables of structures which keep all records (GendersIndex, HostfileCache) are unbounded,
+    tables of a stream of records should set max_size.
+
+    Args:
+        max_size (int): Maximum number of interned strings and split attribute strings. The
+                        table is cleared when it is full. Default: unbounded
+    """
+
+    def __init__(self, max_size=None):
+        """See Class docstring."""
+        self.max_size = max_size
+        self.symbols = {}
+        self.keys = {}
+
+    def __len__(self):
+        """Return the number of interned strings."""
+        return len(self.symbols)
+
+    def intern(self, string):
+        """Return the shared copy of string."""
+        if self.max_size is not None and len(self.symbols) >= self.max_size:
+            self.symbols.clear()
+        return self.symbols.setdefault(string, string)
+
+    def intern_record(self, host_record):
+        """Return host_record using the shared copies of its attributes."""
+        intern = self.intern
+        return HostRecord(host_record[0],
+                          tuple([intern(attribute) for attribute in host_record[1]]))
+
+    def intern_records(self, host_records):
+        """Return a tuple of intern_record of all HostRecords, keeping None."""
+        return tuple(None if host_record is None else self.intern_record(host_record)
+                     for host_record in host_records)
+
+    def get_tokens(self, attributes):
+        """Return a list of the (attribute, key) pairs of the attributes of a HostRecord.
+
+        An attribute is either 'key=value' or just 'key'.
+        """
+        keys = self.keys
+        tokens = []
+        for attribute in attributes:
+            key = keys.get(attribute)
+            if key is None:
+                if self.max_size is not None and len(keys) >= self.max_size:
+                    keys.clear()
+                key = keys[attribute] = self.intern(attribute.partition(u'=')[0])
+            tokens.append((attribute, key))
+        return tokens
+
+
+def get_file_hash(filename, size=None):
+    """Return the sha256 digest of a file or None if it cannot be read.
+
+    Args:
+        filename (str): The file to hash
+        size (int):     The expected size of the file. If the size differs, None is returned
+                        without reading the file.
+    """
+    try:
+        with open(filename, 'rb') as hashedfilehandler:
+            if size is not None and os.fstat(hashedfilehandler.fileno()).st_size != size:
+                return None
+            content_hash = hashlib.sha256()
+            for block in iter(lambda: hashedfilehandler.read(WRITE_BUFFER_SIZE), b''):
+                content_hash.update(block)
+    except (IOError, OSError):
+        return None
+    return content_hash.digest()
+
+
+def get_file_mode(filename):
+    """Return the permissions of filename or the default permissions if it does not exist."""
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+class GendersFileWriter(object):
+    """Write the entries of a genders file into a temporary file and publish it atomically.
+
+    The entries are written to a temporary file in the directory of filename. commit() syncs
+    it to disk and renames it to filename, so readers see either the old or the new file. If
+    filename is a symlink, its target is replaced and the symlink kept.
+    If the new content is the same as the content of the existing file, the existing file is
+    left untouched.
+
+    Args:
+        filename (str): Full path and filename of the genders file. WILL BE OVERWRITTEN!
+    """
+
+    def __init__(self, filename):
+        """See Class docstring."""
+        self.filename = os.path.realpath(filename)
+        (filehandle, self.tempname) = tempfile.mkstemp(
+            dir=dirname(self.filename), prefix='.%s.' % os.path.basename(self.filename))
+        self.filehandler = os.fdopen(filehandle, 'wb', WRITE_BUFFER_SIZE)
+        self.content_hash = hashlib.sha256()
+        self.separator = b''
+        self.entries = 0
+        self.size = 0
+
+    def write(self, gender_entry):
+        """Append an entry."""
+        self.write_line(gender_entry.encode('utf-8'))
+
+    def write_line(self, line):
+        """Append a line (bytes)."""
+        line = self.separator + line
+        self.filehandler.write(line)
+        self.content_hash.update(line)
+        self.separator = b'\n'
+        self.entries += 1
+
+    def commit(self):
+        """Publish the file.
+
+        Returns:
+            True if the file was replaced, False if it was unchanged
+        """
+        try:
+            with self.filehandler:
+                self.size = self.filehandler.tell()
+                if get_file_hash(self.filename, self.size) == self.content_hash.digest():
+                    os.unlink(self.tempname)
+                    return False
+                self.filehandler.flush()
+                os.fsync(self.filehandler.fileno())
+            os.chmod(self.tempname, get_file_mode(self.filename))
+            os.rename(self.tempname, self.filename)
+        except BaseException:
+            self.abort()
+            raise
+        return True
+
+    def abort(self):
+        """Discard the file without replacing the existing one."""
+        self.filehandler.close()
+        if os.path.exists(self.tempname):
+            os.unlink(self.tempname)
+
+
+def iter_file_lines(filename, content_hash=None):
+    """Return an iterator of the lines (bytes without the newline) of a file.
+
+    The lines are the content split by newlines, so a file ending with a newline has an empty
+    last line. A missing file has no lines.
+
+    Args:
+        filename (str):       The file to read
+        content_hash (hash):  Updated with the content of the file while reading (optional)
+    """
+    try:
+        filehandler = open(filename, 'rb')
+    except (IOError, OSError):
+        return
+    with filehandler:
+        line = None
+        for line in filehandler:
+            if content_hash is not None:
+                content_hash.update(line)
+            yield line[:-1] if line.endswith(b'\n') else line
+        if line is not None and line.endswith(b'\n'):
+            yield b''
+
+
+def _split_line(line):
+    """Return the (hostname, attributes) tuple of a line, which sorts like a HostRecord."""
+    (hostname, _, attributes) = line.partition(b'\t')
+    return (hostname, attributes)
+
+
+class GendersDelta(object):
+    """Write a patch from the previous to the new genders file while the new one is written.
+
+    The (sorted) lines of the new file are merged with the lines of the old file like in a
+    merge sort, so neither file is held in memory. The patch consists of a header line and
+    the following operations, one per line:
+
+        =N      copy the next N lines of the old file
+        -LINE   skip the next line of the old file, which is LINE
+        +LINE   add LINE
+
+    Hosts whose entry changed are removed and added. apply_genders_delta reproduces the new
+    file byte for byte from the old file and the patch.
+
+    Args:
+        old_filename (str):   The previous genders file. A missing file counts as empty.
+        patch_filename (str): Atomically write the patch to this file
+    """
+
+    HEADER = b'# generate_hostlist delta 1'
+
+    def __init__(self, old_filename, patch_filename):
+        """See Class docstring."""
+        self.old_hash = hashlib.sha256()
+        self.new_hash = hashlib.sha256()
+        self.__old_lines = iter_file_lines(old_filename, self.old_hash)
+        self.__old_line = next(self.__old_lines, None)
+        self.__separator = b''
+        self.__copied = 0
+        self.unchanged = 0
+        self.added = []
+        self.removed = []
+        self.writer = GendersFileWriter(patch_filename)
+        self.writer.write_line(self.HEADER)
+
+    def __flush_copied(self):
+        """Write the operation copying the unchanged lines since the last change."""
+        if self.__copied:
+            self.writer.write_line(b'=%d' % self.__copied)
+            self.__copied = 0
+
+    def __remove_old_line(self):
+        """Remove the current line of the old file."""
+        self.__flush_copied()
+        self.writer.write_line(b'-' + self.__old_line)
+        self.removed.append(_split_line(self.__old_line)[0])
+        self.__old_line = next(self.__old_lines, None)
+
+    def add_line(self, line):
+        """Add the next line (bytes) of the new file."""
+        self.new_hash.update(self.__separator + line)
+        self.__separator = b'\n'
+        key = _split_line(line)
+        while self.__old_line is not None and _split_line(self.__old_line) < key:
+            self.__remove_old_line()
+        if self.__old_line == line:
+            self.__copied += 1
+            self.unchanged += 1
+            self.__old_line = next(self.__old_lines, None)
+        else:
+            self.__flush_copied()
+            self.writer.write_line(b'+' + line)
+            self.added.append(key[0])
+
+    def add_record(self, host_record):
+        """Add the entry of the next HostRecord of the new file."""
+        for line in host_record.render().encode('utf-8').split(b'\n'):
+            self.add_line(line)
+
+    def close(self):
+        """Remove the remaining old lines, publish the patch and return a summary.
+
+        Returns:
+            A dict of the sha256 of the old and the new file, the number of added, removed,
+            changed and unchanged hosts and the sorted lists of the added, removed and changed
+            hostnames
+        """
+        while self.__old_line is not None:
+            self.__remove_old_line()
+        self.__flush_copied()
+        self.writer.commit()
+        added = set(self.added)
+        removed = set(self.removed)
+        summary = {
+            'old_sha256': self.old_hash.hexdigest(),
+            'new_sha256': self.new_hash.hexdigest(),
+            'unchanged': self.unchanged,
+            'added_hosts': sorted(added - removed),
+            'removed_hosts': sorted(removed - added),
+            'changed_hosts': sorted(added & removed),
+        }
+        for kind in ['added', 'removed', 'changed']:
+            summary[kind + '_hosts'] = [hostname.decode('utf-8', 'replace')
+                                        for hostname in summary[kind + '_hosts']]
+            summary[kind] = len(summary[kind + '_hosts'])
+        return summary
+
+    def abort(self):
+        """Discard the patch."""
+        self.__old_lines.close()
+        self.writer.abort()
+
+
+def apply_genders_delta(old_lines, patch_lines):
+    """Return an iterator of the lines of the new genders file.
+
+    Args:
+        old_lines (iterable):   The lines (bytes) of the old genders file
+        patch_lines (iterable): The lines (bytes) of a patch written by GendersDelta
+    Raises:
+        ValueError if the patch is malformed or does not apply to the old file
+    """
+    old_lines = iter(old_lines)
+    patch_lines = iter(patch_lines)
+    if next(patch_lines, None) != GendersDelta.HEADER:
+        raise ValueError("Not a genders delta")
+    for operation in patch_lines:
+        if operation.startswith(b'='):
+            for _ in range(int(operation[1:])):
+                line = next(old_lines, None)
+                if line is None:
+                    raise ValueError("Delta does not apply: old genders file too short")
+                yield line
+        elif operation.startswith(b'-'):
+            if next(old_lines, None) != operation[1:]:
+                raise ValueError("Delta does not apply: %r not found" % operation[1:])
+        elif operation.startswith(b'+'):
+            yield operation[1:]
+        else:
+            raise ValueError("Invalid delta operation %r" % operation)
+    if next(old_lines, None) is not None:
+        raise ValueError("Delta does not apply: old genders file too long")
+
+
+def apply_genders_delta_file(old_filename, patch_filename, new_filename):
+    """Atomically write the genders file new_filename from the old one and a patch.
+
+    See apply_genders_delta.
+
+    Returns:
+        True if new_filename was replaced, False if it was unchanged
+    """
+    writer = GendersFileWriter(new_filename)
+    try:
+        for line in apply_genders_delta(iter_file_lines(old_filename),
+                                        iter_file_lines(patch_filename)):
+            writer.write_line(line)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+class _DirEntry(object):
+    """Minimal replacement of os.DirEntry for Pythons without scandir."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = join(directory, name)
+
+    def is_file(self):
+        """Return True if the entry is a file or a symlink to a file."""
+        return isfile(self.path)
+
+    def is_dir(self, follow_symlinks=True):
+        """Return True if the entry is a directory (or a symlink to one)."""
+        return isdir(self.path) and (follow_symlinks or not os.path.islink(self.path))
+
+    def stat(self):
+        """Return the stat of the entry."""
+        return os.stat(self.path)
+
+
+def _scandir(directory):
+    """Return an iterator of the DirEntries of directory."""
+    if scandir is not None:
+        return scandir(directory)
+    return (_DirEntry(directory, name) for name in listdir(directory))
+
+
+class GitDirEntry(object):
+    """An entry of a tree in a git repository with the interface of os.DirEntry.
+
+    blob is the tuple of the repository and the id of the object.
+    """
+
+    def __init__(self, directory, name, mode, object_type, blob):
+        """See Class docstring."""
+        self.name = name
+        self.path = directory + '/' + name
+        self.mode = mode
+        self.object_type = object_type
+        self.blob = blob
+
+    def is_file(self):
+        """Return True if the entry is a blob (symlinks are not followed in git trees)."""
+        return self.object_type == 'blob' and self.mode != '120000'
+
+    def is_dir(self, follow_symlinks=True):
+        """Return True if the entry is a tree."""
+        return self.object_type == 'tree'
+
+
+class GitSource(object):
+    """A directory of hostfiles in a git repository, read without a checkout.
+
+    Sources are given as 'git:<repository>@<ref>:<subdir>', e.g.
+    'git:/srv/hieradata.git@master:hosts'. The ref defaults to HEAD and the subdir to the root
+    of the repository ('git:/srv/hieradata.git'). The repository may be bare or have a work
+    tree, which is ignored.
+
+    The tree is listed with a single 'git ls-tree' call. The blobs are read in bulk through one
+    'git cat-file --batch' process by iter_git_blobs.
+
+    Args:
+        path (str): The source as described above
+    """
+
+    PREFIX = 'git:'
+
+    def __init__(self, path):
+        """See Class docstring."""
+        self.path = path.rstrip('/')
+        (repository, _, treeish) = path[len(self.PREFIX):].rpartition('@')
+        if not repository:
+            (repository, treeish) = (treeish, '')
+        (ref, _, subdir) = treeish.partition(':')
+        self.repository = repository
+        self.ref = ref or 'HEAD'
+        self.subdir = subdir.strip('/')
+        self.__entries = None
+
+    @classmethod
+    def is_git_source(cls, path):
+        """Return True if path describes a git source."""
+        return path.startswith(cls.PREFIX)
+
+    def list_tree(self, recursive=False):
+        """Return a dict of the paths of all (sub)trees and lists of their GitDirEntries.
+
+        Raises:
+            OSError if the tree cannot be listed
+        """
+        command = ['git', 'ls-tree', '-z']
+        if recursive:
+            command += ['-r', '-t']
+        command.append('%s:%s' % (self.ref, self.subdir))
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                listing = subprocess.check_output(command, cwd=self.repository, stderr=devnull)
+        except subprocess.CalledProcessError as exc:
+            raise OSError("Cannot list '%s': git ls-tree failed with status %s" % (
+                self.path, exc.returncode))
+        entries = defaultdict(list)
+        for line in listing.split(b'\0'):
+            if not line:
+                continue
+            (info, _, relative_path) = line.decode('utf-8').partition(u'\t')
+            (mode, object_type, object_id) = info.split(u' ')
+            (directory, _, name) = relative_path.rpartition(u'/')
+            directory = self.path + '/' + directory if directory else self.path
+            entries[directory].append(GitDirEntry(directory, name, mode, str(object_type),
+                                                  (self.repository, str(object_id))))
+        return entries
+
+    def scandir(self, directory):
+        """Return the GitDirEntries of a directory (see _scandir)."""
+        if self.__entries is None:
+            raise OSError("Tree of '%s' not listed" % self.path)
+        return iter(self.__entries.get(directory, []))
+
+    def load(self, recursive=False):
+        """List the tree, so it can be read with scandir."""
+        self.__entries = self.list_tree(recursive)
+
+    def iter_blobs(self, blob_ids):
+        """Return an iterator of the contents of the blobs (see iter_git_blobs)."""
+        return iter_git_blobs(self.repository, blob_ids)
+
+
+def iter_git_blobs(repository, blob_ids):
+    """Return an iterator of the contents (bytes) of blobs of a git repository.
+
+    All blobs are read through a single 'git cat-file --batch' process. The ids are written by
+    a thread, so the pipes cannot fill up in both directions. Missing blobs yield None.
+
+    Args:
+        repository (str): Path of the (bare) repository
+        blob_ids (list):  The ids of the blobs to read
+    """
+    process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repository,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write_blob_ids():
+        """Write all blob ids to git and close its input."""
+        try:
+            for blob_id in blob_ids:
+                process.stdin.write(blob_id.encode('ascii') + b'\n')
+            process.stdin.close()
+        except (IOError, OSError, ValueError):
+            pass
+    writer = threading.Thread(target=write_blob_ids)
+    writer.daemon = True
+    writer.start()
+    finished = False
+    try:
+        for _ in blob_ids:
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                yield None
+                continue
+            content = process.stdout.read(int(header[2]))
+            process.stdout.read(1)
+            yield content
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        writer.join()
+        process.wait()
+
+
+class ArchiveDirEntry(object):
+    """A file or directory in an archive with the interface of os.DirEntry.
+
+    blob is the tuple of the archive and the id of the file's content, None for directories.
+    """
+
+    def __init__(self, directory, name, blob=None):
+        """See Class docstring."""
+        self.name = name
+        self.path = directory + '/' + name
+        self.blob = blob
+
+    def is_file(self):
+        """Return True if the entry is a file."""
+        return self.blob is not None
+
+    def is_dir(self, follow_symlinks=True):
+        """Return True if the entry is a directory."""
+        return self.blob is None
+
+
+class ArchiveSource(object):
+    """A tar (optionally compressed) or zip archive of hostfiles, read without extracting it.
+
+    The hostfiles are treated like the files of a directory; in recursive mode the directories
+    of the archive are searched, too. Tar archives are read in a single sequential pass, which
+    keeps the content of all hostfiles in memory until the source is discarded. The id of a
+    file is the sha1 of its content. Zip archives are listed from their central directory and
+    the files are read when needed. The id of a file is its name, CRC32 and size.
+
+    Args:
+        path (str): The path of the archive
+    """
+
+    EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.zip')
+
+    def __init__(self, path):
+        """See Class docstring."""
+        self.path = path.rstrip('/')
+        self.contents = {}
+        self.__entries = None
+
+    @classmethod
+    def is_archive_source(cls, path):
+        """Return True if path is an archive."""
+        return path.endswith(cls.EXTENSIONS) and isfile(path)
+
+    def __iter_tar_members(self, extensions):
+        """Return an iterator of (name, id) tuples of the hostfiles and keep their contents."""
+        with tarfile.open(self.path, 'r|*') as archive:
+            for member in archive:
+                if not member.isfile() or not member.name.endswith(extensions):
+                    continue
+                content = archive.extractfile(member).read()
+                blob_id = hashlib.sha1(content).hexdigest()
+                self.contents[blob_id] = content
+                yield (member.name, blob_id)
+
+    def __iter_zip_members(self, extensions):
+        """Return an iterator of (name, id) tuples of the matching files."""
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith(extensions):
+                    yield (info.filename,
+                           '%s:%08x:%d' % (info.filename, info.CRC & 0xffffffff, info.file_size))
+
+    def load(self, extensions):
+        """Read the listing (and for tar archives the contents) of the archive.
+
+        Args:
+            extensions (tuple): Only files with these extensions are hostfiles
+        Raises:
+            IOError/OSError if the archive cannot be read
+        """
+        if self.path.endswith('.zip'):
+            members = self.__iter_zip_members(extensions)
+        else:
+            members = self.__iter_tar_members(extensions)
+        entries = defaultdict(dict)
+        try:
+            for (name, blob_id) in members:
+                parts = [part for part in name.split('/') if part not in ('', '.')]
+                if not parts or '..' in parts:
+                    continue
+                directory = self.path
+                for part in parts[:-1]:
+                    entries[directory].setdefault(part, ArchiveDirEntry(directory, part))
+                    directory = directory + '/' + part
+                entries[directory][parts[-1]] = ArchiveDirEntry(directory, parts[-1],
+                                                                (self.path, blob_id))
+        except (tarfile.TarError, zipfile.BadZipfile) as exc:
+            raise IOError("Cannot read archive '%s': %s" % (self.path, exc))
+        self.__entries = dict((directory, list(entries[directory].values()))
+                              for directory in entries)
+
+    def scandir(self, directory):
+        """Return the ArchiveDirEntries of a directory (see _scandir)."""
+        if self.__entries is None:
+            raise OSError("Archive '%s' not loaded" % self.path)
+        return iter(self.__entries.get(directory, []))
+
+    def iter_blobs(self, blob_ids):
+        """Return an iterator of the contents of the files with the given ids."""
+        if not self.path.endswith('.zip'):
+            for blob_id in blob_ids:
+                yield self.contents.get(blob_id)
+            return
+        with zipfile.ZipFile(self.path) as archive:
+            for blob_id in blob_ids:
+                try:
+                    yield archive.read(blob_id.rsplit(':', 2)[0])
+                except (KeyError, IOError, zipfile.BadZipfile):
+                    yield None
+
+
+class _NoPhase(object):
+    """Context manager doing nothing, returned for item phases which are not timed."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        """Do nothing."""
+
+    def __exit__(self, *exc_info):
+        """Do nothing."""
+
+
+_NO_PHASE = _NoPhase()
+
+
+class RunStats(object):
+    """Timings and counters of a run.
+
+    The time of a run is split into phases. Phases can be nested; the time spent in a nested
+    phase is not counted for the enclosing phase. Times and counters of hosts rendered by worker
+    processes are added up, so their wall times can exceed the wall time of the run.
+    Phases entered once per host or record (see item_phase) are only timed if detailed is set,
+    as taking the times would cost more than most of these steps. Else their time is counted
+    for the enclosing phase.
+
+    Args:
+        detailed (bool): Time the item phases, too. Default: False
+    """
+
+    def __init__(self, detailed=False):
+        """See Class docstring."""
+        self.detailed = detailed
+        self.started = time.time()
+        self.finished = None
+        self.phases = defaultdict(lambda: [0.0, 0.0])
+        self.counters = defaultdict(int)
+        self.hosts = []
+        self.__stack = []
+        self.__mark = None
+
+    def __charge(self):
+        """Add the time since the last mark to the current phase and set a new mark."""
+        mark = (time.time(), _cpu_time())
+        if self.__stack:
+            phase = self.phases[self.__stack[-1]]
+            phase[0] += mark[0] - self.__mark[0]
+            phase[1] += mark[1] - self.__mark[1]
+        self.__mark = mark
+
+    @contextmanager
+    def phase(self, name):
+        """Count the wall and cpu time of the enclosed block for the phase name."""
+        self.__charge()
+        self.__stack.append(name)
+        try:
+            yield
+        finally:
+            self.__charge()
+            self.__stack.pop()
+
+    def item_phase(self, name):
+        """Return phase(name) if the stats are detailed, else a context manager doing nothing."""
+        if self.detailed:
+            return self.phase(name)
+        return _NO_PHASE
+
+    def count(self, name, increment=1):
+        """Increment the counter name."""
+        self.counters[name] += increment
+
+    def add_host(self, hostname, filename, size, parse_seconds, render_seconds):
+        """Record the size of a hostfile and the time spent parsing and rendering it."""
+        self.hosts.append((hostname, filename, size, parse_seconds, render_seconds))
+
+    def get_totals(self):
+        """Return the phases and counters as plain dicts (e.g. to be merged into other stats)."""
+        return {'phases': {name: list(phase) for (name, phase) in self.phases.items()},
+                'counters': dict(self.counters),
+                'hosts': list(self.hosts)}
+
+    def merge(self, totals):
+        """Add the phases and counters returned by get_totals of other stats."""
+        for (name, (wall, cpu)) in totals['phases'].items():
+            self.phases[name][0] += wall
+            self.phases[name][1] += cpu
+        for (name, value) in totals['counters'].items():
+            self.counters[name] += value
+        self.hosts.extend(totals.get('hosts', ()))
+
+    def get_host_report(self, top=10):
+        """Return a report of the slowest and the largest hostfiles (see add_host).
+
+        Args:
+            top (int): Number of hostfiles listed in each section. Default: 10
+        """
+        slowest = sorted(self.hosts, key=lambda host: host[3] + host[4], reverse=True)
+        largest = sorted(self.hosts, key=lambda host: host[2] or 0, reverse=True)
+        lines = ["Slowest hostfiles (total, parse and render seconds):"]
+        for (hostname, filename, _, parse, render) in slowest[:top]:
+            lines.append("  %8.4f %8.4f %8.4f  %s (%s)" % (
+                parse + render, parse, render, hostname, filename))
+        lines.append("Largest hostfiles (bytes):")
+        for (hostname, filename, size, _, _) in largest[:top]:
+            lines.append("  %10s  %s (%s)" % (size, hostname, filename))
+        return "\n".join(lines)
+
+    def get_dedup_ratio(self):
+        """Return the share of the parsed hostfiles whose content was already parsed."""
+        if not self.counters.get('files_parsed'):
+            return 0.0
+        return float(self.counters.get('files_deduplicated', 0)) / self.counters['files_parsed']
+
+    def finish(self):
+        """Mark the run as finished."""
+        self.finished = time.time()
+
+    @staticmethod
+    def get_peak_rss():
+        """Return the peak resident set size of this process (and of finished children)."""
+        factor = 1 if sys.platform == 'darwin' else 1024
+        return factor * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    def as_dict(self):
+        """Return the stats as dict (e.g. to be dumped as JSON)."""
+        return {
+            'started': self.started,
+            'wall_seconds': (self.finished or time.time()) - self.started,
+            'peak_rss_bytes': self.get_peak_rss(),
+            'phases': {name: {'wall_seconds': phase[0], 'cpu_seconds': phase[1]}
+                       for (name, phase) in self.phases.items()},
+            'counters': dict(self.counters),
+            'dedup_ratio': self.get_dedup_ratio(),
+        }
+
+    def as_prometheus(self, prefix='generate_hostlist'):
+        """Return the stats in the Prometheus text format (e.g. for the textfile collector)."""
+        stats = self.as_dict()
+        lines = []
+
+        def add_metric(name, help_text, values):
+            """Add a gauge with a list of (labels, value) tuples."""
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s gauge" % (prefix, name))
+            for (labels, value) in values:
+                lines.append("%s_%s%s %r" % (prefix, name, labels, value))
+        add_metric('last_run_timestamp_seconds', 'Start of the last run.',
+                   [('', stats['started'])])
+        add_metric('run_wall_seconds', 'Wall time of the last run.',
+                   [('', stats['wall_seconds'])])
+        add_metric('peak_rss_bytes', 'Peak resident set size.',
+                   [('', stats['peak_rss_bytes'])])
+        add_metric('dedup_ratio', 'Share of the hostfiles with already parsed content.',
+                   [('', stats['dedup_ratio'])])
+        for kind in ('wall', 'cpu'):
+            add_metric('phase_%s_seconds' % kind, '%s time per phase.' % kind.capitalize(),
+                       [('{phase="%s"}' % name, phase['%s_seconds' % kind])
+                        for (name, phase) in sorted(stats['phases'].items())])
+        for (name, value) in sorted(stats['counters'].items()):
+            add_metric(name, 'Number of %s.' % name.replace('_', ' '), [('', value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Atomically write the stats to filename.
+
+        Files ending in '.prom' are written in the Prometheus text format, all others as JSON.
+        """
+        if filename.endswith('.prom'):
+            content = self.as_prometheus()
+        else:
+            content = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        filename = os.path.realpath(filename)
+        (filehandle, tempname) = tempfile.mkstemp(dir=dirname(filename), prefix='.genders_stats')
+        try:
+            with os.fdopen(filehandle, 'w') as statsfilehandler:
+                statsfilehandler.write(content)
+            os.chmod(tempname, 0o644)
+            os.rename(tempname, filename)
+        except BaseException:
+            os.unlink(tempname)
+            raise
+
+
+class GendersQueryError(ValueError):
+    """Raised for malformed genders query expressions."""
+
+
+class HostfileSourceError(IOError):
+    """Raised if the hostfiles of the input directories cannot be listed or read."""
+
+
+class GendersIndex(object):
+    """In-memory index of genders entries.
+
+    Every entry gets a host id in the order it was added. Adding the entries of a genders file
+    (which is sorted) therefore keeps the host ids in the order of the hostnames. The hosts are
+    stored as HostRecords sharing their attributes through a SymbolTable. For every attribute
+    and every 'attribute=value' pair the index holds the set of matching host ids.
+
+    Queries use the syntax of nodeattr(1): 'attr' or 'attr=value' select hosts, combined by
+    '&&' (and), '||' (or), '--' (and not) and the prefix '~' (not). '&&' and '--' bind stronger
+    than '||'. Parentheses group expressions.
+    """
+
+    TOKENS = re.compile(r'\s*(\(|\)|&&|\|\||--|~|(?:[^\s()&|~-]|-(?!-))+)\s*')
+
+    def __init__(self, symbols=None):
+        """See Class docstring."""
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.records = []
+        self.attributes = defaultdict(set)
+        self.values = defaultdict(set)
+
+    def __len__(self):
+        """Return the number of hosts."""
+        return len(self.records)
+
+    def add_record(self, host_record):
+        """Add a HostRecord."""
+        host_record = self.symbols.intern_record(host_record)
+        host_id = len(self.records)
+        self.records.append(host_record)
+        for (attribute, key) in self.symbols.get_tokens(host_record[1]):
+            self.attributes[key].add(host_id)
+            if u'=' in attribute:
+                self.values[attribute].add(host_id)
+
+    def add_entry(self, gender_entry):
+        """Add a line of a genders file ("hostname<TAB>attr=value,attr,...")."""
+        self.add_record(HostRecord.parse(gender_entry))
+
+    @classmethod
+    def from_file(cls, filename):
+        """Return the index of an existing genders file."""
+        index = cls()
+        with open(filename, 'rb') as gendersfilehandler:
+            for line in gendersfilehandler:
+                line = line.decode('utf-8').rstrip(u'\n')
+                if line.strip() and not line.startswith(u'#'):
+                    index.add_entry(line)
+        return index
+
+    def get_host_ids(self, attribute, value=None):
+        """Return the set of host ids having the attribute (with the value, if given).
+
+        The returned set belongs to the index and must not be modified.
+        """
+        if value is None:
+            return self.attributes.get(attribute, set())
+        return self.values.get(u'%s=%s' % (attribute, value), set())
+
+    def get_hostnames(self, host_ids):
+        """Return the sorted, unique hostnames of the host ids."""
+        return sorted(set(self.records[host_id][0] for host_id in host_ids))
+
+    def query(self, expression):
+        """Return the sorted hostnames matching a nodeattr-style expression.
+
+        Args:
+            expression (str): e.g. 'role=foobar&&stage=somestage', 'role||~(stage=prod)'
+        Returns:
+            a list of hostnames
+        Raises:
+            GendersQueryError if the expression is malformed
+        """
+        return self.get_hostnames(self.query_host_ids(expression))
+
+    def query_host_ids(self, expression):
+        """Return the set of host ids matching a nodeattr-style expression."""
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.TOKENS.match(expression, position)
+            if match is None:
+                raise GendersQueryError("Cannot parse query '%s' at position %s" % (
+                    expression, position))
+            tokens.append(match.group(1))
+            position = match.end()
+        tokens.reverse()
+        host_ids = self.__parse_or(tokens, expression)
+        if tokens:
+            raise GendersQueryError("Unexpected '%s' in query '%s'" % (tokens[-1], expression))
+        return host_ids
+
+    def __parse_or(self, tokens, expression):
+        host_ids = self.__parse_and(tokens, expression)
+        while tokens and tokens[-1] == '||':
+            tokens.pop()
+            host_ids = host_ids | self.__parse_and(tokens, expression)
+        return host_ids
+
+    def __parse_and(self, tokens, expression):
+        host_ids = self.__parse_not(tokens, expression)
+        while tokens and tokens[-1] in ('&&', '--'):
+            if tokens.pop() == '&&':
+                host_ids = host_ids & self.__parse_not(tokens, expression)
+            else:
+                host_ids = host_ids - self.__parse_not(tokens, expression)
+        return host_ids
+
+    def __parse_not(self, tokens, expression):
+        if not tokens:
+            raise GendersQueryError("Unexpected end of query '%s'" % expression)
+        token = tokens.pop()
+        if token == '~':
+            return set(range(len(self.records))) - self.__parse_not(tokens, expression)
+        if token == '(':
+            host_ids = self.__parse_or(tokens, expression)
+            if not tokens or tokens.pop() != ')':
+                raise GendersQueryError("Missing ')' in query '%s'" % expression)
+            return host_ids
+        if token in (')', '&&', '||', '--'):
+            raise GendersQueryError("Unexpected '%s' in query '%s'" % (token, expression))
+        (attribute, equals, value) = token.partition('=')
+        return self.get_host_ids(attribute, value if equals else None)
+
+
+class GendersDatabase(object):
+    """Write HostRecords to an indexed SQLite database.
+
+    The database is built in a temporary file next to filename and only renamed to filename by
+    close(), so readers see either the old or the new database. If the new database is the same
+    as the existing file, the existing file is left untouched. Symlinks are resolved like by
+    GendersFileWriter. Lookup tools can query it
+    without parsing the genders file, e.g.:
+
+        SELECT hostname FROM genders WHERE attribute = 'role' AND value = 'db'
+
+    Tables:
+        hosts:            id, hostname and the attributes as written to the genders file
+        attributes:       id and name of every attribute
+        attribute_values: id, attribute_id and value (NULL for attributes without value)
+        host_attributes:  value_id and host_id, the inverted index of the attribute values
+        genders (view):   hostname, attribute and value of every attribute of every host
+
+    Args:
+        filename (str):        Full path and filename of the database. WILL BE OVERWRITTEN!
+        symbols (SymbolTable): Table used to split the attributes of the records.
+                               Default: a table of at most SYMBOL_TABLE_SIZE strings
+    """
+
+    VERSION = 1
+    BATCH_SIZE = 10000
+    SYMBOL_TABLE_SIZE = 100000
+    SCHEMA = """
+        CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE hosts (id INTEGER PRIMARY KEY, hostname TEXT NOT NULL,
+                            attributes TEXT NOT NULL);
+        CREATE TABLE attributes (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+        CREATE TABLE attribute_values (id INTEGER PRIMARY KEY, attribute_id INTEGER NOT NULL,
+                                       value TEXT);
+        CREATE TABLE host_attributes (value_id INTEGER NOT NULL, host_id INTEGER NOT NULL,
+                                      PRIMARY KEY (value_id, host_id)) WITHOUT ROWID;
+    """
+    INDEXES = """
+        CREATE INDEX hosts_hostname ON hosts (hostname);
+        CREATE UNIQUE INDEX attributes_name ON attributes (name);
+        CREATE UNIQUE INDEX attribute_values_value ON attribute_values (attribute_id, value);
+        CREATE VIEW genders AS
+            SELECT hosts.hostname AS hostname, attributes.name AS attribute,
+                   attribute_values.value AS value
+            FROM host_attributes
+            JOIN hosts ON hosts.id = host_attributes.host_id
+            JOIN attribute_values ON attribute_values.id = host_attributes.value_id
+            JOIN attributes ON attributes.id = attribute_values.attribute_id;
+    """
+
+    def __init__(self, filename, symbols=None):
+        """See Class docstring."""
+        self.filename = os.path.realpath(filename)
+        self.symbols = symbols if symbols is not None else SymbolTable(self.SYMBOL_TABLE_SIZE)
+        self.attribute_ids = {}
+        self.value_ids = {}
+        self.hosts = []
+        self.host_attributes = []
+        self.host_count = 0
+        (filehandle, self.tempname) = tempfile.mkstemp(
+            dir=dirname(self.filename), prefix='.%s.' % os.path.basename(self.filename))
+        os.close(filehandle)
+        try:
+            self.connection = sqlite3.connect(self.tempname)
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.executescript(self.SCHEMA)
+        except BaseException:
+            os.unlink(self.tempname)
+            raise
+
+    def __get_value_id(self, attribute, key):
+        """Return the id of an attribute ('key=value' or 'key'), adding it if it is new."""
+        value_id = self.value_ids.get(attribute)
+        if value_id is None:
+            attribute_id = self.attribute_ids.get(key)
+            if attribute_id is None:
+                attribute_id = self.attribute_ids[key] = len(self.attribute_ids) + 1
+                self.connection.execute('INSERT INTO attributes VALUES (?, ?)',
+                                        (attribute_id, key))
+            value = attribute[len(key) + 1:] if u'=' in attribute else None
+            value_id = self.value_ids[attribute] = len(self.value_ids) + 1
+            self.connection.execute('INSERT INTO attribute_values VALUES (?, ?, ?)',
+                                    (value_id, attribute_id, value))
+        return value_id
+
+    def add_record(self, host_record):
+        """Add a HostRecord. The host ids are assigned in the order the records are added."""
+        self.host_count += 1
+        self.hosts.append((self.host_count, host_record[0], u",".join(host_record[1])))
+        for (attribute, key) in self.symbols.get_tokens(host_record[1]):
+            self.host_attributes.append((self.__get_value_id(attribute, key), self.host_count))
+        if len(self.hosts) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Insert the buffered hosts."""
+        self.connection.executemany('INSERT INTO hosts VALUES (?, ?, ?)', self.hosts)
+        self.connection.executemany('INSERT OR IGNORE INTO host_attributes VALUES (?, ?)',
+                                    self.host_attributes)
+        self.hosts = []
+        self.host_attributes = []
+
+    def close(self):
+        """Write the indexes and atomically replace the database file.
+
+        Returns:
+            True if the file was replaced, False if it was unchanged
+        """
+        try:
+            self.flush()
+            self.connection.executescript(self.INDEXES)
+            self.connection.executemany('INSERT INTO metadata VALUES (?, ?)', [
+                ('version', str(self.VERSION)),
+                ('hosts', str(self.host_count)),
+            ])
+            self.connection.commit()
+            self.connection.close()
+            with open(self.tempname, 'rb') as databasefilehandler:
+                size = os.fstat(databasefilehandler.fileno()).st_size
+                if get_file_hash(self.filename, size) == get_file_hash(self.tempname):
+                    os.unlink(self.tempname)
+                    return False
+                os.fsync(databasefilehandler.fileno())
+            os.chmod(self.tempname, get_file_mode(self.filename))
+            os.rename(self.tempname, self.filename)
+        except BaseException:
+            self.abort()
+            raise
+        return True
+
+    def abort(self):
+        """Discard the database without replacing the database file."""
+        self.connection.close()
+        if os.path.exists(self.tempname):
+            os.unlink(self.tempname)
+
+
+class DomainMatcher(object):
+    """Find the configured domain of a hostname.
+
+    Domains match whole labels: a hostname belongs to a domain if it is the domain or ends with
+    '.' and the domain (a leading '.' of a configured domain is ignored). The domains are kept in
+    a dict, which is looked up with every suffix of the hostname starting after a '.', from the
+    longest to the shortest, so the longest matching domain wins and a hostname costs one dict
+    lookup per label. The regexes are compiled once.
+
+    Args:
+        domainconfig (dict): Directory of Domains and the corresponding regex to split the
+                             hostnames into attributes.
+    """
+
+    def __init__(self, domainconfig):
+        """See Class docstring."""
+        self.domains = {}
+        for domain in sorted(domainconfig):
+            self.domains.setdefault(domain.lstrip('.'), (domain, re.compile(domainconfig[domain])))
+
+    def match(self, hostname):
+        """Return a tuple of the domain and the compiled regex for hostname or None."""
+        get = self.domains.get
+        found = get(hostname)
+        suffix = hostname.partition('.')[2]
+        while found is None and suffix:
+            found = get(suffix)
+            suffix = suffix.partition('.')[2]
+        return found
+
+
+class HostfileCache(object):
+    """On-disk cache of the genders entries rendered from unchanged hostfiles.
+
+    The HostRecords of every hostfile (one per output, see GendersTarget) are stored with the
+    source name, the path and the signature (mtime, size and inode) of the hostfile and the
+    paths and signatures of the hierarchy layers used for the host (see HieraHierarchy). An
+    entry is only used if the hostfile and these layers are unchanged. The whole cache is
+    discarded if the fingerprint (e.g. of the domain configuration) differs from the one it was
+    saved with.
+
+    Args:
+        filename (str):        Full path and filename of the cache file.
+                               None to keep the entries in memory only.
+        fingerprint (str):     Fingerprint of the configuration the entries were rendered with.
+        symbols (SymbolTable): Share the attributes of the loaded HostRecords through this table.
+    """
+
+    VERSION = 5
+
+    def __init__(self, filename, fingerprint, symbols=None):
+        """See Class docstring."""
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.entries = {}
+        self.new_entries = {}
+        self.layer_signatures = {}
+
+    @staticmethod
+    def get_signature(filename, filestat=None):
+        """Return the signature of a file or None if it cannot be read.
+
+        Args:
+            filename (str):      The file to get the signature for
+            filestat (os.stat):  The already known stat of the file (optional)
+        """
+        if filestat is None:
+            try:
+                filestat = os.stat(filename)
+            except OSError:
+                return None
+        return [filestat.st_mtime, filestat.st_size, filestat.st_ino]
+
+    def load(self):
+        """Read the cache file.
+
+        A missing or unreadable cache file or one written with a different fingerprint results
+        in an empty cache.
+
+        Returns:
+            True if entries could be loaded, else False
+        """
+        self.entries = {}
+        self.new_entries = {}
+        if self.filename is None:
+            return False
+        try:
+            with open(self.filename, 'r') as cachefilehandler:
+                content = json.load(cachefilehandler)
+            if ((content.get('version') != self.VERSION or
+                 content.get('fingerprint') != self.fingerprint)):
+                return False
+            for (name, path, signature, host_records, log_records, layers) in content['entries']:
+                host_records = tuple(
+                    None if host_record is None else
+                    self.symbols.intern_record(HostRecord(*host_record))
+                    for host_record in host_records)
+                self.entries[(name, path)] = (signature, host_records,
+                                              [tuple(log_record) for log_record in log_records],
+                                              [tuple(layer) for layer in layers])
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.entries = {}
+            return False
+        return True
+
+    def get(self, name, path, signature):
+        """Return the cached (HostRecords, log records, layers) tuple or None.
+
+        None is returned if the file or one of the layers used for it changed.
+        """
+        cached = self.entries.get((name, path))
+        if signature is None or cached is None or cached[0] != signature:
+            return None
+        for (layer, layer_signature) in cached[3]:
+            if self.get_layer_signature(layer) != layer_signature:
+                return None
+        self.new_entries[(name, path)] = cached
+        return cached[1:]
+
+    def get_layer_signature(self, path):
+        """Return the signature of a layer file, which is taken only once per run."""
+        try:
+            return self.layer_signatures[path]
+        except KeyError:
+            signature = self.layer_signatures[path] = self.get_signature(path)
+            return signature
+
+    def start(self):
+        """Forget the entries used or set and the layers seen by an unfinished run."""
+        self.new_entries = {}
+        self.layer_signatures = {}
+
+    def set(self, name, path, signature, host_records, log_records, layers=()):
+        """Store the HostRecords, the log records and the layers rendered from a file.
+
+        Args:
+            layers (list): (path, signature) tuples of the layers used for the host, including
+                           the missing ones (see HieraHierarchy.get_layers)
+        """
+        if signature is not None:
+            self.new_entries[(name, path)] = (signature,
+                                              self.symbols.intern_records(host_records),
+                                              log_records,
+                                              layers)
+
+    def save(self):
+        """Atomically write all entries used or set since the last load to the cache file.
+
+        Entries of hostfiles which were not seen in this run are dropped.
+        """
+        if self.filename is None:
+            self.entries = self.new_entries
+            self.new_entries = {}
+            return
+        content = {
+            'version': self.VERSION,
+            'fingerprint': self.fingerprint,
+            'entries': [[name, path, signature, host_records, log_records, layers]
+                        for ((name, path), (signature, host_records, log_records, layers))
+                        in sorted(self.new_entries.items())],
+        }
+        (filehandle, tempname) = tempfile.mkstemp(dir=dirname(self.filename) or '.',
+                                                  prefix='.genders_cache')
+        try:
+            with os.fdopen(filehandle, 'w') as cachefilehandler:
+                json.dump(content, cachefilehandler)
+            os.rename(tempname, self.filename)
+        except BaseException:
+            os.unlink(tempname)
+            raise
+        self.entries = self.new_entries
+        self.new_entries = {}
+
+
+class HieraHierarchy(object):
+    """The shared data layers of a hiera hierarchy (e.g. common.yaml and role/<role>.yaml).
+
+    The levels are paths relative to the data directory in which '%{variable}' (or
+    '%{::variable}') is replaced by the value of the variable for a host. Like in hiera.yaml
+    they are listed from the most specific to the most general level and '.yaml' is appended
+    unless the path already ends in '.yaml' or '.json'. Levels with an unknown or non-scalar
+    variable are skipped, as are missing layer files.
+
+    Every layer file is parsed only once and the merged data of every combination of layers
+    is memoized, as most hosts share the same few layers. The signature of every layer file
+    (see HostfileCache) is taken before it is parsed.
+
+    Args:
+        datadir (str):     The directory containing the layer files
+        levels (list):     The paths of the levels
+        load (function):   Return the parsed data of a layer file
+        max_merged (int):  Maximum number of memoized merges. The memo is cleared when it is
+                           full. Default: 10000
+    """
+
+    INTERPOLATION = re.compile(r'%\{(?:::)?([^}]*)\}')
+
+    def __init__(self, datadir, levels, load, max_merged=10000):
+        """See Class docstring."""
+        self.datadir = datadir
+        self.levels = levels
+        self.load = load
+        self.max_merged = max_merged
+        self.layers = {}
+        self.signatures = {}
+        self.merged = {}
+
+    def interpolate(self, level, variables):
+        """Return the path of the layer file of a level for a host or None.
+
+        Args:
+            level (str):      The path of the level
+            variables (dict): The variables of the host
+        """
+        missing = []
+
+        def replace(match):
+            """Return the value of a variable."""
+            value = variables.get(match.group(1))
+            if isinstance(value, bool) or not isinstance(value, (str, unicode, int, long)):
+                missing.append(match.group(1))
+                return u''
+            value = unicode(value)
+            if u'/' in value or value.startswith(u'.'):
+                missing.append(match.group(1))
+            return value
+        path = self.INTERPOLATION.sub(replace, level)
+        if missing:
+            return None
+        if not path.endswith(('.yaml', '.json')):
+            path += '.yaml'
+        return join(self.datadir, path)
+
+    def get_layer(self, path):
+        """Return the parsed data of a layer file or None if it does not exist."""
+        try:
+            return self.layers[path]
+        except KeyError:
+            self.signatures[path] = HostfileCache.get_signature(path)
+            layer = self.layers[path] = self.load(path) if isfile(path) else None
+            return layer
+
+    def get_layers(self, variables, dependencies=None):
+        """Return a tuple of the existing layer files of a host from general to specific.
+
+        Args:
+            variables (dict):    The variables of the host
+            dependencies (dict): If given, the signatures of all layer files of the host
+                                 (None for missing ones) are added to it by their path
+        """
+        paths = []
+        for level in reversed(self.levels):
+            path = self.interpolate(level, variables)
+            if path is None:
+                continue
+            if self.get_layer(path) is not None:
+                paths.append(path)
+            if dependencies is not None:
+                dependencies[path] = self.signatures[path]
+        return tuple(paths)
+
+    def get_data(self, layers):
+        """Return the merged data of layers (see get_layers).
+
+        The top level keys of more specific layers override those of more general ones.
+        The returned dict is shared and must not be changed.
+        """
+        try:
+            return self.merged[layers]
+        except KeyError:
+            data = {}
+            for path in layers:
+                data.update(self.layers[path])
+            if len(self.merged) >= self.max_merged:
+                self.merged.clear()
+            self.merged[layers] = data
+            return data
+
+    def get_signature(self, exclude=()):
+        """Return the sorted paths and signatures of all files in the data directory.
+
+        Args:
+            exclude (list): Directories below the data directory which are skipped
+        """
+        exclude = set(os.path.abspath(path) for path in exclude)
+        signature = []
+        for (directory, directories, filenames) in os.walk(self.datadir):
+            directories[:] = [name for name in directories
+                              if os.path.abspath(join(directory, name)) not in exclude]
+            for filename in filenames:
+                path = join(directory, filename)
+                signature.append([os.path.relpath(path, self.datadir),
+                                  HostfileCache.get_signature(path)])
+        return sorted(signature)
+
+
+class GendersTarget(object):
+    """An additional genders file rendered from the same hostfiles with other domains.
+
+    The hostfiles are parsed once for the genders file of the generator and all its targets.
+    Only the hostnames are classified and the entries rendered for every target.
+
+    Args:
+        gendersfile (str):   The genders file to write
+        domainconfig (dict): Domains and the regexes to split the hostnames
+                             (see GenerateGenders)
+        hosts (list):        Only write the hosts whose hostname matches one of these globs.
+                             Default: None (all hosts)
+    """
+
+    def __init__(self, gendersfile, domainconfig, hosts=None):
+        """See Class docstring."""
+        self.gendersfile = gendersfile
+        self.domainconfig = domainconfig
+        self.domain_matcher = DomainMatcher(domainconfig)
+        self.hosts = hosts or []
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a GendersTarget of a dict with the keys gendersfile, domain and hosts."""
+        if isinstance(config, cls):
+            return config
+        return cls(config['gendersfile'], config.get('domain') or {}, config.get('hosts'))
+
+    def matches(self, hostname):
+        """Return True if the host is written to the genders file of this target."""
+        if not self.hosts:
+            return True
+        return any(fnmatch(hostname, pattern) for pattern in self.hosts)
 
 
 class GenerateGenders(object):
@@ -25,52 +2183,275 @@ class GenerateGenders(object):
         verbosity (str):                   Loglevel.
                                            Allowed Keywords: DEBUG, INFO, WARNING, CRITICAL
                                            Default: WARNING
+        jobs (int):                        Number of processes used to parse the hostfiles.
+                                           Default: 1 (no process pool)
+        cache (str):                       Full path and filename of a cache file for the
+                                           entries of unchanged hostfiles. True to keep the
+                                           entries in memory only (e.g. for watch mode).
+                                           Default: None (no cache)
+        sort_buffer_size (int):            Maximum size in bytes of the entries sorted in
+                                           memory before using temporary files.
+                                           Default: 64 MiB, None for no limit
+        recursive (bool):                  Search the input directories recursively.
+                                           Hidden directories and symlinks to directories
+                                           are skipped.
+                                           Default: False
+        include (list of str):             Only use hostfiles whose path relative to the input
+                                           directory match one of these globs.
+                                           Default: None (all hostfiles)
+        exclude (list of str):             Skip files and directories whose path relative to
+                                           the input directory match one of these globs.
+                                           Default: None
+        yaml_backend (str):                Parser for the hostfiles.
+                                           Allowed Keywords: auto (libyaml if available),
+                                           c (libyaml), python (PyYAML), yamlreader.
+                                           All but yamlreader also read '.json' hostfiles.
+                                           Default: yamlreader
+        statsfile (str):                   Write the stats of every run to this file as JSON
+                                           or (if it ends in '.prom') in the Prometheus text
+                                           format. Default: None
+        build_index (bool):                Keep an index of all written entries in self.hosts
+                                           to be queried with query(). Default: False
+        index_output (str):                Also write the entries to this SQLite database
+                                           (see GendersDatabase). Default: None
+        log_format (str):                  Format of the log messages.
+                                           Allowed Keywords: text, json
+                                           Default: text
+        io_concurrency (int):              Number of hostfiles read ahead in parallel by
+                                           threads (e.g. on NFS) while parsing in this process.
+                                           Only used without a process pool (jobs=1).
+                                           Default: 1 (read every file when parsing it)
+        shard_by (str):                    Also write a genders file for every value of this
+                                           attribute (e.g. source or stage) containing the
+                                           hosts with this value. Default: None (no shards)
+        shard_filename (str):              Filename of the shards, '{shard}' is replaced by the
+                                           value. Default: gendersfile + '.{shard}'
+        combined (bool):                   Write the genders file with all hosts. Can be
+                                           disabled if only the shards are needed.
+                                           Default: True
+        delta_output (str):                Also write a patch from the previous to the new
+                                           genders file (see GendersDelta). Default: None
+        delta_summary (str):               Write the added, removed and changed hosts as
+                                           JSON to this file. Default: None
+        delta_base (str):                  The previous genders file the delta is computed
+                                           against. Default: gendersfile
+        hierarchy (list):                  Levels of a hiera hierarchy merged below the
+                                           hostfile, from the most specific to the most general
+                                           (e.g. ['role/%{role}', 'common']). The variables are
+                                           the attributes from the hostname and the hostfile,
+                                           fqdn and source (see HieraHierarchy). Default: None
+        hieradata (str):                   The directory containing the levels of the
+                                           hierarchy. Required with a hierarchy.
+        profile (str):                     Run generate_genders_file with cProfile and dump
+                                           the pstats to this file. The size and the parse
+                                           and render time of every parsed hostfile are
+                                           recorded in the stats (see
+                                           RunStats.get_host_report). Default: None
+        targets (list):                    Additional genders files rendered from the same
+                                           parsed hostfiles, as GendersTarget or dicts with
+                                           the keys gendersfile, domain and hosts (optional
+                                           globs of the hostnames to write). Default: None
+        include_attributes (list):         Only read the attributes of the hostfiles
+                                           matching one of these globs. Default: None (all)
+        exclude_attributes (list):         Skip the attributes of the hostfiles matching one
+                                           of these globs. Default: None
+        max_depth (int):                   Skip collections in the hostfiles nested deeper
+                                           (0: only scalar attributes). The skipped parts of
+                                           the hostfiles are never constructed (see
+                                           AttributeProjection). Default: None (no limit)
     """
 
+    PARSED_CONTENTS = 10000  # Maximum number of parsed hostfile contents shared in a run
+    SYMBOL_TABLE_SIZE = 100000  # Maximum size of the table splitting the attributes of records
+    SHARD_WRITERS = 8  # Maximum number of shards published in parallel
+
     def __init__(self,
                  inputdirectories,
                  gendersfile,
                  domainconfig,
-                 verbosity='WARNING'
+                 verbosity='WARNING',
+                 jobs=1,
+                 cache=None,
+                 sort_buffer_size=64 * 1024 * 1024,
+                 recursive=False,
+                 include=None,
+                 exclude=None,
+                 yaml_backend='yamlreader',
+                 statsfile=None,
+                 build_index=False,
+                 index_output=None,
+                 log_format='text',
+                 io_concurrency=1,
+                 shard_by=None,
+                 shard_filename=None,
+                 combined=True,
+                 delta_output=None,
+                 delta_summary=None,
+                 delta_base=None,
+                 hierarchy=None,
+                 hieradata=None,
+                 profile=None,
+                 targets=None,
+                 include_attributes=None,
+                 exclude_attributes=None,
+                 max_depth=None
                  ):
         """See Class docstring."""
         self.inputdirectories = inputdirectories
         self.gendersfile = gendersfile
-        self.log = self.__create_logger(verbosity)
+        self.log = get_logger(verbosity, log_format)
         self.domainconfig = domainconfig
-        self.hosts = {}
+        self.jobs = jobs or 1
+        self.cache = cache
+        self.__hostfile_cache = None
+        self.__blob_sources = {}
+        self.sort_buffer_size = sort_buffer_size
+        self.recursive = recursive
+        self.include = include or []
+        self.exclude = exclude or []
+        self.yaml_backend = yaml_backend
+        self.statsfile = statsfile
+        self.stats = RunStats()
+        self.build_index = build_index
+        self.index_output = index_output
+        self.io_concurrency = io_concurrency or 1
+        self.shard_by = shard_by
+        self.shard_filename = shard_filename
+        self.combined = combined
+        self.delta_output = delta_output
+        self.delta_summary = delta_summary
+        self.delta_base = delta_base
+        if hierarchy and not hieradata:
+            raise ValueError("A hierarchy requires the directory of the hiera data (hieradata)")
+        self.hierarchy = hierarchy or []
+        self.hieradata = hieradata
+        self.__hiera = None
+        self.__layers = None
+        self.profile = profile
+        self.targets = [GendersTarget.from_config(target) for target in targets or []]
+        self.__parsed = {}
+        self.projection = None
+        if include_attributes or exclude_attributes or max_depth is not None:
+            self.projection = AttributeProjection(include_attributes, exclude_attributes,
+                                                  max_depth)
+        self.symbols = SymbolTable()
+        self.tokens = SymbolTable(self.SYMBOL_TABLE_SIZE)
+        self.renderer = AttributeRenderer()
+        self.hosts = GendersIndex(self.symbols)
 
-    @staticmethod
-    def __create_logger(verbosity):
-        logger = logging.getLogger(__name__)
-        logger.setLevel(getattr(logging, verbosity, 30))
-        console_logger = logging.StreamHandler()
-        formatter = logging.Formatter('%(levelname)s:%(message)s')
-        console_logger.setFormatter(formatter)
-        logger.addHandler(console_logger)
-        return logger
+    @property
+    def domainconfig(self):
+        """Directory of Domains and the corresponding regex to split the hostnames."""
+        return self.__domainconfig
+
+    @domainconfig.setter
+    def domainconfig(self, domainconfig):
+        self.__domainconfig = domainconfig
+        self.domain_matcher = DomainMatcher(domainconfig)
+
+    @property
+    def yaml_backend(self):
+        """Parser used for the hostfiles (one of 'c', 'python' or 'yamlreader')."""
+        return self.__yaml_backend
+
+    @yaml_backend.setter
+    def yaml_backend(self, yaml_backend):
+        if yaml_backend not in YAML_BACKENDS:
+            raise ValueError("Unknown YAML backend '%s'. Use one of %s" % (
+                yaml_backend, ", ".join(YAML_BACKENDS)))
+        if yaml_backend in ('auto', 'c'):
+            if hasattr(yaml, 'CSafeLoader'):
+                yaml_backend = 'c'
+            else:
+                if yaml_backend == 'c':
+                    self.warning("libyaml is not available, using the python YAML parser")
+                yaml_backend = 'python'
+        self.__yaml_backend = yaml_backend
+        if yaml_backend == 'yamlreader':
+            self.hostfile_extensions = ('.yaml',)
+        else:
+            self.hostfile_extensions = ('.yaml', '.json')
+
+    def debug(self, message, *args):
+        """Write debug message to logger. message is only formatted with args if enabled."""
+        self.log.debug(message, *args)
+
+    def info(self, message, *args):
+        """Write info message to logger. message is only formatted with args if enabled."""
+        self.log.info(message, *args)
+
+    def warning(self, message, *args):
+        """Write warning message to logger. message is only formatted with args if enabled."""
+        self.log.warning(message, *args)
+
+    def critical(self, message, *args):
+        """Write critical message to logger. message is only formatted with args if enabled."""
+        self.log.critical(message, *args)
+
+    def iter_hostfiles(self, directory, list_directory=None):
+        """Return an iterator of all hostfiles in the given directory.
+
+        All files ending in '.yaml' (or '.json' if the yaml_backend supports it) will be treated
+        as hiera hostfile, unless they are filtered by self.include or self.exclude.
+        In recursive mode all subdirectories are searched, too. The directory is read with
+        scandir, so the type of the entries is known without additional calls to stat.
 
-    def debug(self, message):
-        """Write debug message to logger."""
-        self.log.debug(message)
+        Args:
+            directory -- Read files from this directory
+            list_directory -- Function returning the DirEntries of a directory
+                              Default: scandir (e.g. GitSource.scandir for git sources)
+
+        Returns:
+            An iterator of (directory path, hostname, DirEntry) tuples
+            The filename of the hostfile is the name of the DirEntry.
 
-    def info(self, message):
-        """Write info message to logger."""
-        self.log.info(message)
+        """
+        list_directory = list_directory or _scandir
+        pending = [(directory, '')]
+        while pending:
+            (path, prefix) = pending.pop()
+            for entry in list_directory(path):
+                relative_path = prefix + entry.name
+                if [pattern for pattern in self.exclude if fnmatch(relative_path, pattern)]:
+                    continue
+                if entry.name.endswith(self.hostfile_extensions) and len(entry.name) > 5:
+                    if not entry.is_file():
+                        continue
+                    if ((self.include and
+                         not [pattern for pattern in self.include
+                              if fnmatch(relative_path, pattern)])):
+                        continue
+                    self.debug("Found host '%s'", entry.name[:-5])
+                    yield (path, entry.name[:-5], entry)
+                elif ((self.recursive and not entry.name.startswith('.') and
+                       entry.is_dir(follow_symlinks=False))):
+                    pending.append((entry.path, relative_path + '/'))
 
-    def warning(self, message):
-        """Write warning message to logger."""
-        self.log.warning(message)
+    def iter_source_hostfiles(self, path):
+        """Return an iterator of all hostfiles of an input directory, git source or archive.
 
-    def critical(self, message):
-        """Write critical message to logger."""
-        self.log.critical(message)
+        See iter_hostfiles, GitSource and ArchiveSource. The DirEntries of git sources and
+        archives have the additional attribute blob, a tuple of the source's key and the id of
+        the hostfile's content. The contents are read by iter_prefetched.
+        """
+        if GitSource.is_git_source(path):
+            source = GitSource(path)
+            source.load(self.recursive)
+            self.__blob_sources[source.repository] = source
+        elif ArchiveSource.is_archive_source(path):
+            source = ArchiveSource(path)
+            source.load(self.hostfile_extensions)
+            self.__blob_sources[source.path] = source
+        else:
+            return self.iter_hostfiles(path)
+        return self.iter_hostfiles(source.path, source.scandir)
 
     def get_all_hosts_from_directory(self, directory):
         """Return a list of all hosts from given directory.
 
         All files ending in '.yaml' will be treated as hiera hostfile,
         stripped of their extention and returned as host.
+        See iter_hostfiles for the filters and the recursive mode.
 
         Args:
             directory -- Read files from this directory
@@ -79,86 +2460,747 @@ class GenerateGenders(object):
             A list of hostnames
 
         """
-        self.info("Getting hosts from '%s'" % directory)
-        hostlist = []
-        for filename in listdir(directory):
-            if ((isfile(join(directory, filename)) and
-                 filename.endswith(".yaml") and
-                 len(filename) > 5)):
-                self.debug("Found host '%s'" % filename[:-5])
-                hostlist.append(filename[:-5])
-        return hostlist
+        self.info("Getting hosts from '%s'", directory)
+        return [hostname for (_, hostname, _) in self.iter_source_hostfiles(directory)]
 
-    def get_attributes_from_hostname(self, hostname):
+    def get_attributes_from_hostname(self, hostname, target=None):
         """Return all attributes parsted from the hostname.
 
         Parses the given hostname according to the appropiate configuration in self.domainconfig.
+        If several configured domains match, the longest one is used.
         If a hostname has no corresponding domainconfig or does not fit the regex a warning will be
         logged and an empty dict will be returned.
 
         Args:
-            hostname (str): The hostname to be parsed.
+            hostname (str):         The hostname to be parsed.
+            target (GendersTarget): Use the domains of this target. Default: None
         Returns:
             if the domain is configured correctly and the hostname can be parsed:
                 a dict of attributes
             else:
                 an empty dict.
         """
-        for domain in self.domainconfig.keys():
-            if hostname.endswith(domain):
-                try:
-                    return re.match(self.domainconfig[domain], hostname).groupdict()
-                except AttributeError:
-                    self.warning("Hostname '{}' does not match the Regex '{}'".format(
-                        hostname,
-                        self.domainconfig[domain]
-                    ))
-                    return {}
-        self.warning("Could not get attributes from hostname '{}'.".format(hostname) +
-                     " No matching config found.")
-        return {}
-
-    def get_config_from_file(self, filename):
+        target = target or self
+        with self.stats.item_phase('hostname_parsing'):
+            match = target.domain_matcher.match(hostname)
+            if match is None:
+                self.stats.count('unmatched_hostnames')
+                self.warning("Could not get attributes from hostname '%s'."
+                             " No matching config found.", hostname)
+                return {}
+            (domain, regex) = match
+            try:
+                return regex.match(hostname).groupdict()
+            except AttributeError:
+                self.stats.count('unmatched_hostnames')
+                self.warning("Hostname '%s' does not match the Regex '%s'",
+                             hostname, target.domainconfig[domain])
+                return {}
+
+    def classify_hostnames(self, hostnames):
+        """Return the attributes parsed from many hostnames.
+
+        Args:
+            hostnames (iterable): The hostnames to be parsed.
+        Returns:
+            a dict of the hostnames and their attributes (see get_attributes_from_hostname)
+        """
+        return {hostname: self.get_attributes_from_hostname(hostname) for hostname in hostnames}
+
+    def get_config_from_file(self, filename, content=None):
         """Return the host configuration from the hostfile.
 
         Parses the given YAML-File and returns the content. Will log a warning in case of malformed
         YAML or missing file and return and empty dict
 
+        Hostfiles with identical content (e.g. generated from a template) are parsed only once
+        per run. They share the returned data, so a dict is returned as ReadOnlyDict.
+
         Args:
-            filename (str): a filname (with path) to Read
+            filename (str):  a filname (with path) to Read
+            content (bytes): the already read content of the file. Default: None (read the file)
         Returns:
             on success: a dict of attributes
             on failure: an empty dict
         """
+        self.stats.count('files_parsed')
+        return self.__load_config(filename, content, 'files_deduplicated')
+
+    def __load_config(self, filename, content, deduplicated):
+        """Return the parsed hostfile or layer, parsing identical contents only once per run.
+
+        See get_config_from_file. The counter deduplicated counts the contents already parsed.
+        """
+        if content is None:
+            with self.stats.item_phase('yaml_loading'):
+                content = read_file(filename)
+        digest = None
+        if content is not None:
+            digest = (filename.endswith('.json'), hashlib.sha1(content).digest())
+            parsed = self.__parsed.get(digest)
+            if parsed is not None:
+                self.stats.count(deduplicated)
+                return parsed
         try:
-            return yaml_load(filename) or {}
+            with self.stats.item_phase('yaml_loading'):
+                parsed = self.load_hostfile(filename, content) or {}
         except YamlReaderError as exc:
-            self.warning("Hostfile '{}' not a proper YAML-File: {}".format(filename, exc))
+            self.stats.count('parse_failures')
+            self.warning("Hostfile '%s' not a proper YAML-File: %s", filename, exc)
             return {}
+        if isinstance(parsed, dict):
+            parsed = ReadOnlyDict(parsed)
+        if digest is not None:
+            if len(self.__parsed) >= self.PARSED_CONTENTS:
+                self.__parsed.clear()
+            self.__parsed[digest] = parsed
+        return parsed
 
-    def get_gender_entry_for_host(self, directory_name, directory_path, hostname):
-        """Return an entry for a genders file.
+    def load_hostfile(self, filename, content=None):
+        """Return the content of a hostfile parsed by the configured yaml_backend.
+
+        Args:
+            filename (str):  a filname (with path) to Read
+            content (bytes): the already read content of the file. yamlreader can only read
+                             files by name, so with this backend the content (or a projection,
+                             see self.projection) is parsed with PyYAML's safe loader, which
+                             yamlreader uses, too, and errors are logged like yamlreader does.
+                             Default: None (read the file)
+        Returns:
+            the parsed content
+        Raises:
+            YamlReaderError if the file is missing or malformed
+        """
+        if self.yaml_backend == 'yamlreader':
+            if content is None and self.projection is None:
+                return yaml_load(filename)
+            try:
+                return load_yaml_file(filename, yaml.SafeLoader, content, self.projection)
+            except YamlReaderError as exc:
+                logging.getLogger('yamlreader.yamlreader').error("%s", exc)
+                raise
+        if filename.endswith('.json'):
+            return load_json_file(filename, content, self.projection)
+        if self.yaml_backend == 'c':
+            return load_yaml_file(filename, yaml.CSafeLoader, content, self.projection)
+        return load_yaml_file(filename, yaml.SafeLoader, content, self.projection)
+
+    def get_host_record(self, directory_name, directory_path, hostname, filename=None,
+                        content=None):
+        """Return the HostRecord of a host.
+
+        Merges the attributes from the parsed hostname, the layers of the hierarchy and the
+        attributes from the hostfile (each overriding the former).
+
+        Args:
+            directory_name (str): The name of the source directory for the host
+            directory_path (str): The path of the directory containing the hostfile
+            hostname (str):       A string of the hostname
+            filename (str):       The name of the hostfile in the directory.
+                                  Default: hostname + '.yaml'
+            content (bytes):      The already read content of the hostfile.
+                                  Default: None (read the file)
+        Returns:
+            a HostRecord of the hostname and its rendered attributes
+        """
+        return self.get_host_records(directory_name, directory_path, hostname, filename,
+                                     content)[0]
+
+    def get_host_records(self, directory_name, directory_path, hostname, filename=None,
+                         content=None):
+        """Return the HostRecords of a host for the genders file and all targets.
+
+        The hostfile is parsed once, the hostname is classified and the attributes are rendered
+        for every target (see get_host_record).
+
+        Returns:
+            a tuple of the HostRecord for the genders file followed by the HostRecords for
+            self.targets (None if the host is not written to the target)
+        """
+        filepath = join(directory_path, filename or hostname + ".yaml")
+        self.info("Generating Enty for %s (from %s:%s)", hostname, directory_name, filepath)
+        started = time.time()
+        configs = [self.get_attributes_from_hostname(hostname)]
+        if content is None:
+            file_config = self.get_config_from_file(filepath)
+        else:
+            file_config = self.get_config_from_file(filepath, content)
+        for target in self.targets:
+            if target.matches(hostname):
+                configs.append(self.get_attributes_from_hostname(hostname, target))
+            else:
+                configs.append(None)
+        for config in configs:
+            if config is None:
+                continue
+            if self.hierarchy:
+                config.update(self.get_hierarchy_data(hostname, directory_name, config,
+                                                      file_config))
+            config.update(file_config)
+        parsed = time.time()
+        with self.stats.item_phase('rendering'):
+            host_records = tuple(
+                None if config is None else
+                HostRecord(hostname, self.renderer.render_tokens(directory_name, config))
+                for config in configs)
+        if self.profile:
+            if content is None:
+                try:
+                    size = os.path.getsize(filepath)
+                except OSError:
+                    size = None
+            else:
+                size = len(content)
+            self.stats.add_host(hostname, filepath, size, parsed - started, time.time() - parsed)
+        return host_records
 
-        Merges the attributes from the parsed hostname and the attributes from the hostfile.
+    def get_hierarchy_data(self, hostname, directory_name, hostname_config, file_config):
+        """Return the merged data of the hierarchy levels of a host.
+
+        The layers are parsed once per run and their merges memoized (see HieraHierarchy).
 
         Args:
-            directory_info (tuple): A tuple of (Name and Path) of the source directory for the host
-            hostname (str):         A string of the hostname
+            hostname (str):         The hostname, available as variable fqdn
+            directory_name (str):   The name of the source directory, available as source
+            hostname_config (dict): The attributes from the hostname
+            file_config (dict):     The attributes from the hostfile (overriding the former)
+        Returns:
+            a dict of attributes, which must not be changed
+        """
+        hiera = self.__hiera
+        if hiera is None:
+            hiera = self.__hiera = HieraHierarchy(self.hieradata, self.hierarchy,
+                                                  self.load_layer)
+        variables = {'fqdn': hostname, 'source': directory_name}
+        variables.update(hostname_config)
+        variables.update(file_config)
+        with self.stats.item_phase('hierarchy'):
+            layers = hiera.get_layers(variables, self.__layers)
+            if layers not in hiera.merged:
+                self.stats.count('layer_merges')
+            return hiera.get_data(layers)
+
+    def load_layer(self, filename):
+        """Return the parsed data of a layer file of the hierarchy."""
+        self.stats.count('layers_parsed')
+        data = self.__load_config(filename, None, 'layers_deduplicated')
+        if not isinstance(data, dict):
+            self.warning("Layer '%s' does not contain a hash, ignoring it", filename)
+            return {}
+        return data
+
+    def get_gender_entry_for_host(self, directory_name, directory_path, hostname, filename=None):
+        """Return an entry for a genders file.
+
+        See get_host_record.
+
         Returns:
             a string containing the hostname and all attributes to be used in a genders file
         """
-        filepath = join(directory_path, hostname + ".yaml")
-        self.info("Generating Enty for %s (from %s:%s)" % (hostname, directory_name, filepath))
-        config = self.get_attributes_from_hostname(hostname)
-        file_config = self.get_config_from_file(filepath)
-        config.update(file_config)
-        config_list = ["source=%s" % (directory_name)]
-        for (key, value) in config.items():
-            value = re.sub(r"[ #,=]", "_", unicode(value))
-            config_list.append('%s=%s' % (key, value))
-        config_list.sort()
-        config_string = ",".join(config_list)
-        return u"{}	{}".format(hostname, config_string)
+        return self.get_host_record(directory_name, directory_path, hostname, filename).render()
+
+    def get_host_tasks(self):
+        """Return a list of all hosts to generate entries for.
+
+        The stat of the hostfiles is only read if a cache is configured.
+
+        Returns:
+            A list of HostTask tuples of directory name, path of the hostfile's directory,
+            hostname, filename of the hostfile, the stat of the hostfile (or None) and the
+            (source key, blob id) tuple of hostfiles from git sources and archives (or None)
+        """
+        host_tasks = []
+        self.__blob_sources = {}
+        with self.stats.phase('discovery'):
+            for directory_name in self.inputdirectories:
+                path = self.inputdirectories[directory_name]
+                self.debug("Iterating over hosts in '%s'", path)
+                self.info("Getting hosts from '%s'", path)
+                for (hostfile_path, hostname, entry) in self.iter_source_hostfiles(path):
+                    filestat = None
+                    blob = getattr(entry, 'blob', None)
+                    if self.cache and blob is None:
+                        try:
+                            filestat = entry.stat()
+                        except OSError:
+                            pass
+                    host_tasks.append(HostTask(directory_name, hostfile_path, hostname,
+                                               entry.name, filestat, blob))
+        self.stats.count('files_scanned', len(host_tasks))
+        return host_tasks
+
+    def get_input_snapshot(self):
+        """Return the sorted paths and signatures of all hostfiles (e.g. to detect changes).
+
+        Unlike get_host_tasks this does not touch self.stats or the sources of the last run.
+        Archives are represented by the signature of the archive file instead of being read.
+        """
+        snapshot = []
+        for path in self.inputdirectories.values():
+            if ArchiveSource.is_archive_source(path):
+                snapshot.append((path, HostfileCache.get_signature(path)))
+                continue
+            if GitSource.is_git_source(path):
+                source = GitSource(path)
+                source.load(self.recursive)
+                hostfiles = self.iter_hostfiles(source.path, source.scandir)
+            else:
+                hostfiles = self.iter_hostfiles(path)
+            for (directory, _, entry) in hostfiles:
+                blob = getattr(entry, 'blob', None)
+                if blob is not None:
+                    signature = [blob[1]]
+                else:
+                    try:
+                        signature = HostfileCache.get_signature(None, entry.stat())
+                    except OSError:
+                        signature = None
+                snapshot.append((join(directory, entry.name), signature))
+        return sorted(snapshot)
+
+    def iter_prefetched(self, host_tasks, read_ahead=True):
+        """Return an iterator of (host task, content of the hostfile) tuples.
+
+        The hostfiles of git sources and archives are read in bulk from their source (see
+        GitSource and ArchiveSource).
+        With read_ahead and an io_concurrency above 1, the other hostfiles are read by as many
+        threads ahead of the consumer, so the latency of a (network) filesystem overlaps with
+        parsing. At most twice io_concurrency files are held in memory.
+        Without read ahead (or if a file cannot be read) the content is None.
+        The host tasks keep their order.
+        """
+        files = [host_task for host_task in host_tasks if host_task.blob is None]
+        blob_ids = defaultdict(list)
+        for host_task in host_tasks:
+            if host_task.blob is not None:
+                blob_ids[host_task.blob[0]].append(host_task.blob[1])
+        blobs = dict((key, self.__blob_sources[key].iter_blobs(blob_ids[key]))
+                     for key in blob_ids)
+        file_contents = None
+        if read_ahead and self.io_concurrency > 1 and len(files) > 1:
+            file_contents = self.__read_ahead(files)
+        try:
+            for host_task in host_tasks:
+                if host_task.blob is not None:
+                    yield host_task, next(blobs[host_task.blob[0]])
+                elif file_contents is not None:
+                    yield host_task, next(file_contents)
+                else:
+                    yield host_task, None
+        finally:
+            for contents in list(blobs.values()) + [file_contents]:
+                if contents is not None:
+                    contents.close()
+
+    def __read_ahead(self, host_tasks):
+        """Return an iterator of the contents of the hostfiles read by threads."""
+        with self.stats.phase('io_wait'):
+            pool = ThreadPool(self.io_concurrency)
+        try:
+            pending = deque()
+            for host_task in host_tasks:
+                filepath = join(host_task.directory_path, host_task.filename)
+                pending.append(pool.apply_async(read_file, (filepath,)))
+                if len(pending) >= 2 * self.io_concurrency:
+                    with self.stats.phase('io_wait'):
+                        content = pending.popleft().get()
+                    yield content
+            while pending:
+                with self.stats.phase('io_wait'):
+                    content = pending.popleft().get()
+                yield content
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def render_host_task(self, host_task, content=None):
+        """Return the HostRecords, the emitted log messages and the layers of a host task.
+
+        The log messages are recorded instead of being written, so they can be written by the
+        parent process in the same order as in a serial run.
+
+        Args:
+            host_task (HostTask): The host to render the entry for
+            content (bytes):      The already read content of the hostfile. Default: None
+        Returns:
+            a tuple of the HostRecords (see get_host_records), a list of (loglevel, message)
+            tuples and a sorted list of the (path, signature) tuples of the hierarchy layers of
+            the host (see HieraHierarchy.get_layers)
+        """
+        recorder = _LogRecorder(self.log)
+        logger, self.log = self.log, recorder
+        self.__layers = {}
+        try:
+            host_records = self.get_host_records(*host_task[:4], content=content)
+            layers = sorted(self.__layers.items())
+        finally:
+            self.log = logger
+            self.__layers = None
+        return host_records, recorder.records, layers
+
+    @staticmethod
+    def get_signature(host_task):
+        """Return the signature of the hostfile of a host task (see HostfileCache).
+
+        The signature of a hostfile from a git source or an archive is its blob id.
+        """
+        if host_task.blob is not None:
+            return [host_task.blob[1]]
+        return HostfileCache.get_signature(join(host_task.directory_path, host_task.filename),
+                                           host_task.filestat)
+
+    def get_cache_fingerprint(self):
+        """Return a fingerprint of the configuration affecting the rendered entries."""
+        configuration = {'domain': self.domainconfig}
+        if self.projection is not None:
+            configuration['projection'] = [self.projection.include, self.projection.exclude,
+                                           self.projection.max_depth]
+        if self.targets:
+            configuration['targets'] = [[target.domainconfig, target.hosts]
+                                        for target in self.targets]
+        if self.hierarchy:
+            # Changed layers are detected by the cache entries of the hosts using them
+            configuration['hierarchy'] = [self.hieradata, self.hierarchy]
+        configuration = json.dumps(configuration, sort_keys=True)
+        return hashlib.sha1(configuration.encode('utf-8')).hexdigest()
+
+    def get_hostfile_cache(self):
+        """Return the HostfileCache for self.cache.
+
+        The cache is kept between runs and only (re)loaded if the cache file or the fingerprint
+        changed.
+        """
+        filename = None if self.cache is True else self.cache
+        fingerprint = self.get_cache_fingerprint()
+        cache = self.__hostfile_cache
+        if cache is None or cache.filename != filename or cache.fingerprint != fingerprint:
+            cache = HostfileCache(filename, fingerprint, SymbolTable())
+            if not cache.load() and filename is not None:
+                self.info("Cache '%s' not usable, parsing all hostfiles", filename)
+            self.__hostfile_cache = cache
+        cache.start()
+        return cache
+
+    def render_host_tasks(self, host_tasks):
+        """Return an iterator of the results of render_host_task in the order of the host tasks.
+
+        If more than one job is configured, the hostfiles are parsed by a pool of processes.
+        Else they are read ahead by self.io_concurrency threads (see iter_prefetched).
+        """
+        if self.jobs <= 1 or len(host_tasks) <= 1:
+            for (host_task, content) in self.iter_prefetched(host_tasks):
+                yield self.render_host_task(host_task, content)
+            return
+        self.debug("Parsing %s hosts with %s jobs", len(host_tasks), self.jobs)
+        chunksize = max(1, len(host_tasks) // (self.jobs * 4))
+        with self.stats.phase('workers'):
+            pool = Pool(self.jobs, _init_worker, (self,))
+        try:
+            # The stat of scandir entries cannot be pickled and is not needed by the workers
+            results = pool.imap(_render_in_worker,
+                                ((host_task._replace(filestat=None), content)
+                                 for (host_task, content)
+                                 in self.iter_prefetched(host_tasks, read_ahead=False)),
+                                chunksize)
+            for _ in host_tasks:
+                with self.stats.phase('workers'):
+                    (host_records, log_records, layers, totals) = next(results)
+                self.stats.merge(totals)
+                yield host_records, log_records, layers
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def iter_host_records(self):
+        """Return an iterator of the (unsorted) HostRecords of all hosts for the genders file.
+
+        See iter_all_host_records.
+        """
+        for host_records in self.iter_all_host_records():
+            yield host_records[0]
+
+    def iter_target_records(self):
+        """Return an iterator of the (unsorted) TargetRecords of all hosts and outputs.
+
+        Output 0 is the genders file, output n the n-th target in self.targets.
+        See iter_all_host_records.
+        """
+        for host_records in self.iter_all_host_records():
+            for (target, host_record) in enumerate(host_records):
+                if host_record is not None:
+                    yield TargetRecord(target, host_record)
+
+    def iter_all_host_records(self):
+        """Return an iterator of the (unsorted) HostRecords of all hosts.
+
+        Every host yields a tuple of its HostRecords for the genders file and self.targets (see
+        get_host_records).
+        If more than one job is configured, the hostfiles are parsed by a pool of processes.
+        If a cache is configured, only new or changed hostfiles are parsed. The cache is saved
+        after the last entry.
+        Log messages are written in the order of the hosts, so the output is the same as
+        parsing all hosts in this process.
+        The attributes of the records are interned in the bounded table self.tokens, so the
+        records held by the sort share the strings of common values.
+        Errors listing or reading the hostfiles are raised as HostfileSourceError.
+        """
+        try:
+            for host_records in self.__iter_all_host_records():
+                yield host_records
+        except (IOError, OSError) as exc:
+            raise HostfileSourceError(str(exc))
+
+    def __iter_all_host_records(self):
+        """Return an iterator of the HostRecords of all hosts (see iter_all_host_records)."""
+        host_tasks = self.get_host_tasks()
+        intern_records = self.tokens.intern_records
+        if not self.cache and self.jobs <= 1:
+            for (host_task, content) in self.iter_prefetched(host_tasks):
+                yield intern_records(self.get_host_records(*host_task[:4], content=content))
+            return
+        cached_entries = [None] * len(host_tasks)
+        signatures = [None] * len(host_tasks)
+        cache = None
+        if self.cache:
+            with self.stats.phase('cache'):
+                cache = self.get_hostfile_cache()
+                for (index, host_task) in enumerate(host_tasks):
+                    filepath = join(host_task.directory_path, host_task.filename)
+                    signatures[index] = self.get_signature(host_task)
+                    cached_entries[index] = cache.get(host_task.directory_name, filepath,
+                                                      signatures[index])
+        missing = [host_tasks[index] for (index, cached) in enumerate(cached_entries)
+                   if cached is None]
+        self.stats.count('cache_hits', len(host_tasks) - len(missing))
+        self.debug("Parsing %s of %s hostfiles", len(missing), len(host_tasks))
+        rendered_missing = self.render_host_tasks(missing)
+        for (index, rendered) in enumerate(cached_entries):
+            if rendered is None:
+                rendered = next(rendered_missing)
+                if cache is not None:
+                    host_task = host_tasks[index]
+                    cache.set(host_task.directory_name,
+                              join(host_task.directory_path, host_task.filename),
+                              signatures[index],
+                              *rendered)
+            cached_entries[index] = None
+            (host_records, log_records, _) = rendered
+            for (level, message) in log_records:
+                self.log.log(level, message)
+            yield intern_records(host_records)
+        if cache is not None:
+            try:
+                with self.stats.phase('cache'):
+                    cache.save()
+            except (IOError, OSError) as exc:
+                self.warning("Cannot write cache '%s': %s", self.cache, exc)
+
+    def iter_gender_entries(self):
+        """Return an iterator of the (unsorted) genders entries of all hosts.
+
+        See iter_host_records.
+        """
+        for host_record in self.iter_host_records():
+            yield host_record.render()
+
+    def get_gender_entries(self):
+        """Return the (unsorted) genders entries of all hosts.
+
+        See iter_gender_entries.
+
+        Returns:
+            a list of strings to be used in a genders file
+        """
+        return list(self.iter_gender_entries())
+
+    def write_genders_file(self, gender_entries, gendersfile=None):
+        """Atomically replace the genders file.
+
+        The entries are streamed into a temporary file in the directory of the genders file,
+        which is synced to disk and renamed to the genders file. Readers will see either the old
+        or the new file, never a partially written one.
+        If the new content is the same as the content of the existing genders file, the
+        existing file is left untouched.
+
+        Args:
+            gender_entries (iterable): The (sorted) entries of the genders file
+            gendersfile (str):         The genders file to write. Default: self.gendersfile
+        Returns:
+            True if the genders file was replaced, False if it was unchanged
+        """
+        gendersfile = gendersfile or self.gendersfile
+        writer = GendersFileWriter(gendersfile)
+        try:
+            for gender_entry in gender_entries:
+                writer.write(gender_entry)
+        except BaseException:
+            writer.abort()
+            raise
+        self.stats.count('entries_written', writer.entries)
+        if not writer.commit():
+            self.info("Gendersfile '%s' is unchanged", gendersfile)
+            return False
+        self.stats.count('bytes_written', writer.size)
+        return True
+
+    def __add_to_index(self, index, host_records):
+        """Add the HostRecords to index while iterating over them."""
+        for host_record in host_records:
+            with self.stats.item_phase('indexing'):
+                index.add_record(host_record)
+            yield host_record
+
+    def get_shard(self, host_record):
+        """Return the value of the attribute self.shard_by of a HostRecord or None."""
+        for (attribute, key) in self.tokens.get_tokens(host_record[1]):
+            if key == self.shard_by and u'=' in attribute:
+                return attribute[len(key) + 1:]
+        return None
+
+    def get_shard_filename(self, shard):
+        """Return the filename of the genders file of a shard."""
+        pattern = self.shard_filename or self.gendersfile + '.{shard}'
+        return pattern.format(shard=shard.replace(u'/', u'_'))
+
+    def get_shard_manifest(self):
+        """Return the filename of the list of shards written by the last run."""
+        gendersfile = os.path.abspath(self.gendersfile)
+        return join(dirname(gendersfile), '.%s-shards' % os.path.basename(gendersfile))
+
+    def __add_to_shards(self, shards, spill, host_records):
+        """Spill the HostRecords of all shards to one file while iterating over them.
+
+        The records are written to spill as TargetRecords of the index of their shard in the
+        dict shards (shard -> index), new shards are added to it. Hosts without the attribute
+        self.shard_by are not written to any shard.
+        """
+        for host_record in host_records:
+            with self.stats.item_phase('sharding'):
+                shard = self.get_shard(host_record)
+                if shard is None:
+                    self.stats.count('unsharded_hosts')
+                else:
+                    index = shards.setdefault(shard, len(shards))
+                    spill.write(_escape_entry(TargetRecord(index, host_record).render())
+                                .encode('utf-8') + b'\n')
+            yield host_record
+
+    def __commit_shards(self, shards, spill):
+        """Write the genders files of all shards and publish them in parallel.
+
+        The spilled records are sorted by shard, so the shards are written one after the other.
+        Written shards are published by a pool of threads, at most SHARD_WRITERS of them are
+        open at the same time.
+
+        Returns:
+            True if any shard was replaced
+        """
+        spill.seek(0)
+        shard_streams = iter_target_streams(
+            sort_entries(_read_sorted_chunk(spill, TargetRecord.parse),
+                         self.sort_buffer_size,
+                         dirname(os.path.abspath(self.gendersfile)),
+                         TargetRecord.render,
+                         TargetRecord.parse),
+            len(shards))
+        pool = ThreadPool(min(len(shards), self.SHARD_WRITERS))
+        pending = deque()
+        changed = []
+        try:
+            for (shard, host_records) in zip(sorted(shards, key=shards.get), shard_streams):
+                if len(pending) >= self.SHARD_WRITERS:
+                    changed.append(self.__finish_shard(*pending.popleft()))
+                writer = GendersFileWriter(self.get_shard_filename(shard))
+                try:
+                    for host_record in host_records:
+                        writer.write(host_record.render())
+                except BaseException:
+                    writer.abort()
+                    raise
+                pending.append((writer, pool.apply_async(writer.commit)))
+            while pending:
+                changed.append(self.__finish_shard(*pending.popleft()))
+        finally:
+            pool.close()
+            pool.join()
+        self.stats.count('shards_written', len(changed))
+        self.stats.count('shards_changed', changed.count(True))
+        return True in changed
+
+    def __remove_stale_shards(self, shards):
+        """Remove the shards of the last run which were not written in this run.
+
+        The filenames of the written shards are kept in a manifest (see get_shard_manifest), so
+        only genders files written as shards are removed.
+
+        Returns:
+            True if any shard was removed
+        """
+        manifest = self.get_shard_manifest()
+        filenames = set(os.path.abspath(self.get_shard_filename(shard)) for shard in shards)
+        try:
+            with io.open(manifest, 'r', encoding='utf-8') as manifesthandler:
+                previous = manifesthandler.read().splitlines()
+        except (IOError, OSError):
+            previous = []
+        removed = 0
+        for filename in previous:
+            if filename not in filenames and os.path.lexists(filename):
+                os.remove(filename)
+                removed += 1
+                self.info("Removed stale shard '%s'", filename)
+        writer = GendersFileWriter(manifest)
+        for filename in sorted(filenames):
+            writer.write(filename)
+        writer.commit()
+        self.stats.count('shards_removed', removed)
+        return removed > 0
+
+    def __finish_shard(self, writer, result):
+        """Return whether the shard of writer was replaced, once its commit is done."""
+        shard_changed = result.get()
+        if not shard_changed:
+            self.info("Gendersfile '%s' is unchanged", writer.filename)
+        return shard_changed
+
+    def __add_to_delta(self, delta, host_records):
+        """Add the HostRecords to the GendersDelta delta while iterating over them."""
+        for host_record in host_records:
+            with self.stats.item_phase('delta'):
+                delta.add_record(host_record)
+            yield host_record
+
+    def __finish_delta(self, delta):
+        """Publish the patch of delta and write its summary to self.delta_summary."""
+        summary = delta.close()
+        for kind in ['added', 'removed', 'changed']:
+            self.stats.count('hosts_' + kind, summary[kind])
+        self.info("Delta: %s hosts added, %s removed, %s changed",
+                  summary['added'], summary['removed'], summary['changed'])
+        if self.delta_summary:
+            writer = GendersFileWriter(self.delta_summary)
+            writer.write(unicode(json.dumps(summary, indent=2, sort_keys=True)))
+            writer.commit()
+
+    def __add_to_database(self, database, host_records):
+        """Add the HostRecords to database while iterating over them."""
+        for host_record in host_records:
+            with self.stats.item_phase('index_output'):
+                database.add_record(host_record)
+            yield host_record
+
+    def query(self, expression):
+        """Return the sorted hostnames matching a nodeattr-style expression.
+
+        Uses the index of the last run (see build_index and GendersIndex.query).
+        """
+        return self.hosts.query(expression)
 
     def generate_genders_file(self):
         """Write the genders file.
@@ -167,27 +3209,235 @@ class GenerateGenders(object):
         get all hostsfiles and the corresponding attributes and write everything to the
         genders file in self.gendersfile
 
+        The entries are sorted in memory up to self.sort_buffer_size bytes and by an external
+        merge sort in temporary files next to the genders file above that.
+
+        Timings and counters of the run are kept in self.stats and written to self.statsfile.
+        The counter gendersfile_changed is 0 if the genders file was left untouched because its
+        content did not change.
+        If self.build_index is set, self.hosts is replaced by an index of the written entries.
+        If self.index_output is set, the entries are also written to this SQLite database in the
+        same pass. The database is replaced after the genders file, even if the genders file was
+        unchanged.
+        If self.shard_by is set, a genders file is written for every value of this attribute in
+        the same pass. The shards are published in parallel after the genders file (which is
+        skipped if self.combined is False).
+        Shards of the last run whose value is gone are removed.
+        If self.delta_output is set, the new entries are compared with the previous genders file
+        (self.delta_base) in the same pass and the patch is written to self.delta_output.
+        If self.targets are configured, the entries of all targets are rendered from the same
+        parsed hostfiles, sorted in one pass and their genders files written after the genders
+        file.
+        If self.profile is set, the run is profiled with cProfile (only this process, not the
+        workers) and the pstats are dumped to self.profile.
+
         Args:
             None
         Return:
-            None
+            True if the genders file (or a shard) was replaced, False if it was unchanged
         """
-        gendersfile_content = []
-        self.debug("Writing gendersfile '%s'" % self.gendersfile)
-        for directory_name in self.inputdirectories:
-            path = self.inputdirectories[directory_name]
-            self.debug("Iterating over hosts in '%s'" % path)
-            for hostname in self.get_all_hosts_from_directory(path):
-                gender_entry = self.get_gender_entry_for_host(
-                    directory_name,
-                    path,
-                    hostname)
-                gendersfile_content.append(gender_entry)
-        gendersfile_content.sort()
-        try:
-            gendersfile_string = "\n".join(gendersfile_content)
-            with open(self.gendersfile, 'w') as gendersfilehandler:
-                gendersfilehandler.write(gendersfile_string.encode('utf-8'))
-        except Exception as exc:
-            self.critical("Cannot write to gendersfile '%s': %s" % (self.gendersfile, exc))
+        if not self.profile:
+            return self.__generate_genders_file()
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.__generate_genders_file)
+        finally:
+            profiler.dump_stats(self.profile)
+
+    def __generate_genders_file(self):
+        """Write the genders file (see generate_genders_file)."""
+        self.stats = RunStats(bool(self.profile))
+        self.symbols = SymbolTable()
+        self.tokens = SymbolTable(self.SYMBOL_TABLE_SIZE)
+        self.__hiera = None
+        self.__parsed = {}
+        self.debug("Writing gendersfile '%s'", self.gendersfile)
+        database = None
+        delta = None
+        shards = {}
+        spill = None
+        target_streams = []
+        try:
+            with self.stats.phase('sorting'):
+                if self.targets:
+                    target_streams = iter_target_streams(
+                        sort_entries(self.iter_target_records(),
+                                     self.sort_buffer_size,
+                                     dirname(os.path.abspath(self.gendersfile)),
+                                     TargetRecord.render,
+                                     TargetRecord.parse),
+                        len(self.targets) + 1)
+                    sorted_records = target_streams[0]
+                else:
+                    sorted_records = sort_entries(self.iter_host_records(),
+                                                  self.sort_buffer_size,
+                                                  dirname(os.path.abspath(self.gendersfile)),
+                                                  HostRecord.render,
+                                                  HostRecord.parse)
+            if self.build_index:
+                index = GendersIndex(self.symbols)
+                sorted_records = self.__add_to_index(index, sorted_records)
+            if self.index_output:
+                with self.stats.phase('index_output'):
+                    database = GendersDatabase(self.index_output, self.tokens)
+                sorted_records = self.__add_to_database(database, sorted_records)
+            if self.shard_by:
+                spill = tempfile.TemporaryFile(dir=dirname(os.path.abspath(self.gendersfile)),
+                                               prefix='.genders_shards')
+                sorted_records = self.__add_to_shards(shards, spill, sorted_records)
+            if self.delta_output:
+                with self.stats.phase('delta'):
+                    delta = GendersDelta(self.delta_base or self.gendersfile, self.delta_output)
+                sorted_records = self.__add_to_delta(delta, sorted_records)
+            with self.stats.phase('writing'):
+                if self.combined:
+                    changed = self.write_genders_file(host_record.render()
+                                                      for host_record in sorted_records)
+                else:
+                    changed = False
+                    deque(sorted_records, maxlen=0)
+                if shards:
+                    changed = self.__commit_shards(shards, spill) or changed
+                if self.shard_by:
+                    changed = self.__remove_stale_shards(shards) or changed
+                for (target, host_records) in zip(self.targets, target_streams[1:]):
+                    changed = self.write_genders_file((host_record.render()
+                                                       for host_record in host_records),
+                                                      target.gendersfile) or changed
+            if database is not None:
+                with self.stats.phase('index_output'):
+                    database.close()
+                database = None
+            if delta is not None:
+                with self.stats.phase('delta'):
+                    self.__finish_delta(delta)
+                delta = None
+            if self.build_index:
+                self.hosts = index
+            self.stats.count('gendersfile_changed', int(changed))
+        except HostfileSourceError as exc:
+            self.critical("Cannot read hostfiles: %s", exc)
+            raise
+        except (IOError, OSError) as exc:
+            self.critical("Cannot write to gendersfile '%s': %s", self.gendersfile, exc)
+            raise
+        except sqlite3.Error as exc:
+            self.critical("Cannot write index database '%s': %s", self.index_output, exc)
             raise
+        finally:
+            self.__blob_sources = {}
+            if database is not None:
+                database.abort()
+            if spill is not None:
+                spill.close()
+            if delta is not None:
+                delta.abort()
+            self.stats.finish()
+            if self.statsfile:
+                try:
+                    self.stats.write(self.statsfile)
+                except (IOError, OSError) as exc:
+                    self.warning("Cannot write stats to '%s': %s", self.statsfile, exc)
+        return changed
+
+
+class GendersWatcher(object):
+    """Regenerate the genders file whenever the hostfiles change.
+
+    The input directories (and the hiera data of a hierarchy) are watched with inotify if
+    pyinotify is available, else they are scanned every poll_interval seconds. Bursts of
+    changes (e.g. a git checkout) are collected until no change happened for debounce seconds.
+    The generator keeps its cache between runs, so only new or changed hostfiles are parsed
+    before the genders file is replaced.
+
+    Args:
+        generator (GenerateGenders): The generator to run. If it has no cache configured, the
+                                     entries are cached in memory.
+        debounce (float):            Seconds without changes before regenerating. Default: 2
+        poll_interval (float):       Seconds between scans without inotify. Default: 10
+    """
+
+    def __init__(self, generator, debounce=2.0, poll_interval=10.0):
+        """See Class docstring."""
+        self.generator = generator
+        if not generator.cache:
+            generator.cache = True
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.running = False
+        self.snapshot = None
+        self.notifier = self.__create_notifier()
+
+    def __create_notifier(self):
+        if pyinotify is None:
+            self.generator.info("pyinotify not available, polling every %ss", self.poll_interval)
+            return None
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        watch_manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watch_manager, lambda event: None)
+        paths = [(path, self.generator.recursive)
+                 for path in self.generator.inputdirectories.values()]
+        if self.generator.hierarchy:
+            paths.append((self.generator.hieradata, True))
+        for (path, recursive) in paths:
+            watches = watch_manager.add_watch(path, mask, rec=recursive, auto_add=recursive)
+            if [descriptor for descriptor in watches.values() if descriptor < 0]:
+                self.generator.warning("Cannot watch '%s', polling every %ss",
+                                       path, self.poll_interval)
+                notifier.stop()
+                return None
+        return notifier
+
+    def get_snapshot(self):
+        """Return the sorted paths and signatures of all hostfiles and hierarchy layers."""
+        snapshot = self.generator.get_input_snapshot()
+        if self.generator.hierarchy:
+            snapshot.append(HieraHierarchy(self.generator.hieradata, [], None).get_signature(
+                self.generator.inputdirectories.values()))
+        return snapshot
+
+    def wait_for_change(self, timeout):
+        """Return True if any hostfile changed within timeout seconds."""
+        if self.notifier is not None:
+            if not self.notifier.check_events(int(timeout * 1000)):
+                return False
+            self.notifier.read_events()
+            self.notifier.process_events()
+            return True
+        time.sleep(timeout)
+        snapshot = self.get_snapshot()
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+    def regenerate(self):
+        """Write the genders file, logging instead of raising errors."""
+        try:
+            self.generator.generate_genders_file()
+        except Exception as exc:  # pylint: disable=broad-except
+            self.generator.critical("Cannot regenerate gendersfile '%s': %s",
+                                    self.generator.gendersfile, exc)
+
+    def run(self):
+        """Write the genders file and rewrite it on every change until stop is called."""
+        self.running = True
+        if self.notifier is None:
+            self.snapshot = self.get_snapshot()
+        self.regenerate()
+        while self.running:
+            if not self.wait_for_change(self.poll_interval if self.notifier is None else 1):
+                continue
+            deadline = time.time() + 10 * self.debounce
+            while self.running and time.time() < deadline and self.wait_for_change(self.debounce):
+                self.generator.debug("Waiting for more changes")
+            if self.running:
+                self.generator.info("Hostfiles changed, regenerating gendersfile")
+                self.regenerate()
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def stop(self):
+        """Stop watching after the current wait."""
+        self.running = False
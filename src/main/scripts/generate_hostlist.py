@@ -2,8 +2,9 @@
 """Script to generate a gendersfile from a Puppet host list."""
 import argparse
 import copy as _copy
+import sys
 from yamlreader import yaml_load, data_merge, YamlReaderError
-from generate_hostlist import GenerateGenders
+from generate_hostlist import GenerateGenders, GendersWatcher, LOG_FORMATS, YAML_BACKENDS
 
 
 class list2dictStore(argparse._AppendAction):
@@ -51,7 +52,11 @@ def __parse_args(*args):
                         help="""Directory of hiera host files.
                         Can be added multiple times.
                         The (short) name (without spaces) will be added
-                        as source attribute to the genders file.""",
+                        as source attribute to the genders file.
+                        Use git:REPOSITORY@REF:SUBDIR to read the host
+                        files from a git repository without a checkout.
+                        .tar, .tar.gz, .tar.bz2 and .zip archives are
+                        read without extracting them.""",
                         action=list2dictStore,
                         nargs=2,
                         metavar=("NAME", "DIRECTORY")
@@ -72,8 +77,200 @@ def __parse_args(*args):
                         Possible entries are:
                         gendersfile (str), input (list of tuples),
                         domain (list of tuples), verbosity (one of
-                        "DEBUG", "INFO", "WARNING", "CRITICAL")"""
+                        "DEBUG", "INFO", "WARNING", "CRITICAL"),
+                        jobs (int), cache (str), sort_buffer_size (int),
+                        recursive (bool), include (list), exclude (list),
+                        yaml_backend (str), watch (bool),
+                        debounce (float), poll_interval (float),
+                        stats (str), unchanged_exit_status (int),
+                        index_output (str), log_format (str),
+                        io_concurrency (int), shard_by (str),
+                        shard_filename (str), combined (bool),
+                        delta_output (str), delta_summary (str),
+                        delta_base (str), hierarchy (list),
+                        hieradata (str), profile (str),
+                        profile_top (int), targets (list of dicts
+                        with gendersfile, domain and hosts),
+                        include_attributes (list),
+                        exclude_attributes (list), max_depth (int)"""
                         )
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="""Number of processes used to parse
+                        the hiera host files (1)""",
+                        type=int,
+                        )
+    parser.add_argument("--io-concurrency",
+                        help="""Number of host files read ahead in parallel,
+                        e.g. on network filesystems. Only used with
+                        one job (1)""",
+                        type=int,
+                        metavar="N",
+                        )
+    parser.add_argument("-r",
+                        "--recursive",
+                        help="Search the input directories recursively",
+                        action='store_const',
+                        const=True,
+                        )
+    parser.add_argument("--include-attribute",
+                        dest="include_attributes",
+                        help="""Only read the attributes of the host files
+                        matching the glob. Can be added multiple times.""",
+                        action='append',
+                        metavar="GLOB",
+                        )
+    parser.add_argument("--exclude-attribute",
+                        dest="exclude_attributes",
+                        help="""Skip the attributes of the host files
+                        matching the glob without constructing them.
+                        Can be added multiple times.""",
+                        action='append',
+                        metavar="GLOB",
+                        )
+    parser.add_argument("--max-depth",
+                        help="""Skip lists and hashes in the host files
+                        nested deeper than this (0: only scalar
+                        attributes)""",
+                        type=int,
+                        metavar="DEPTH",
+                        )
+    parser.add_argument("--hierarchy",
+                        help="""Level of a hiera hierarchy merged below the
+                        host files, e.g. role/%%{role} or common. %%{VAR}
+                        is replaced by attributes of the host. Can be
+                        added multiple times, most specific first.""",
+                        action='append',
+                        metavar="LEVEL",
+                        )
+    parser.add_argument("--hieradata",
+                        help="""Directory containing the levels of the
+                        hierarchy""",
+                        metavar="DIRECTORY",
+                        )
+    parser.add_argument("--include",
+                        help="""Only use host files whose path relative to
+                        the input directory matches the glob.
+                        Can be added multiple times.""",
+                        action='append',
+                        metavar="GLOB",
+                        )
+    parser.add_argument("--exclude",
+                        help="""Skip files and directories whose path relative
+                        to the input directory matches the glob.
+                        Can be added multiple times.""",
+                        action='append',
+                        metavar="GLOB",
+                        )
+    parser.add_argument("--yaml-backend",
+                        help="""Parser for the host files (yamlreader).
+                        All but yamlreader also read '.json' host files.""",
+                        choices=YAML_BACKENDS,
+                        )
+    parser.add_argument("--sort-buffer-size",
+                        help="""Sort at most this many bytes of entries in
+                        memory and use temporary files above (67108864)""",
+                        type=int,
+                        metavar="BYTES",
+                        )
+    parser.add_argument("--stats",
+                        help="""Write timings and counters of every run to
+                        this file as JSON or (if it ends in '.prom') for
+                        the Prometheus node_exporter textfile collector""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--shard-by",
+                        help="""Also write a genders file for every value of
+                        this attribute (e.g. source or stage)""",
+                        metavar="ATTRIBUTE",
+                        )
+    parser.add_argument("--shard-filename",
+                        help="""Filename of the shards, {shard} is replaced by
+                        the value of the attribute (GENDERSFILE.{shard})""",
+                        metavar="PATTERN",
+                        )
+    parser.add_argument("--no-combined",
+                        dest="combined",
+                        help="""Only write the shards, not the genders file
+                        with all hosts""",
+                        action='store_const',
+                        const=False,
+                        )
+    parser.add_argument("--delta-output",
+                        help="""Also write a patch with the added, removed and
+                        changed entries since the previous genders file""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--delta-summary",
+                        help="""Write the added, removed and changed hosts as
+                        JSON to this file (requires --delta-output)""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--delta-base",
+                        help="""Previous genders file to compute the delta
+                        against (GENDERSFILE)""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--index-output",
+                        help="""Also write the genders entries to this
+                        indexed SQLite database for fast lookups""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--profile",
+                        help="""Profile the run with cProfile, write the
+                        pstats to this file and print the slowest and
+                        largest host files. The stats also get the
+                        timings of the per-host phases""",
+                        metavar="FILE",
+                        )
+    parser.add_argument("--profile-top",
+                        help="""Number of host files in each section of the
+                        profile report (10)""",
+                        type=int,
+                        metavar="N",
+                        )
+    parser.add_argument("--unchanged-exit-status",
+                        help="""Exit with this status if the genders file was
+                        left untouched because its content did not change (0)""",
+                        type=int,
+                        metavar="STATUS",
+                        )
+    parser.add_argument("-w",
+                        "--watch",
+                        help="""Keep running and regenerate the genders file
+                        whenever the host files change""",
+                        action='store_const',
+                        const=True,
+                        )
+    parser.add_argument("--debounce",
+                        help="""In watch mode wait for this many seconds
+                        without changes before regenerating (2)""",
+                        type=float,
+                        metavar="SECONDS",
+                        )
+    parser.add_argument("--poll-interval",
+                        help="""In watch mode scan the input directories every
+                        this many seconds if inotify is not available (10)""",
+                        type=float,
+                        metavar="SECONDS",
+                        )
+    parser.add_argument("--log-format",
+                        help="""Write log messages as text (LEVEL:message)
+                        or as one JSON object per line (text)""",
+                        choices=LOG_FORMATS,
+                        )
+    cache_parser = parser.add_mutually_exclusive_group()
+    cache_parser.add_argument("--cache",
+                              help="""Cache the entries of unchanged host files
+                              in this file""",
+                              metavar="PATH",
+                              )
+    cache_parser.add_argument("--no-cache",
+                              dest="cache",
+                              action='store_const',
+                              const=False,
+                              help="Do not use a cache (even if configured)",
+                              )
     verbosity_parser = parser.add_mutually_exclusive_group()
     verbosity_parser.add_argument("-v",
                                   "--verbose",
@@ -91,9 +288,12 @@ def __parse_args(*args):
                                   )
     parser.set_defaults(verbosity='WARNING')
     if args:
-        return parser.parse_args(args)
+        parsed_args = parser.parse_args(args)
     else:
-        return parser.parse_args()
+        parsed_args = parser.parse_args()
+    if parsed_args.delta_summary and not (parsed_args.delta_output or parsed_args.config):
+        parser.error("--delta-summary requires --delta-output")
+    return parsed_args
 
 
 def __main():
@@ -111,12 +311,54 @@ def __main():
     if 'gendersfile' not in config_data:
         config_data['gendersfile'] = '/etc/genders'
     genders_generator = GenerateGenders(
-        config_data.get('input'),
-        config_data.get('gendersfile'),
-        config_data.get('domain', {}),
-        config_data.get('verbosity')
+        inputdirectories=config_data.get('input'),
+        gendersfile=config_data.get('gendersfile'),
+        domainconfig=config_data.get('domain', {}),
+        verbosity=config_data.get('verbosity'),
+        jobs=config_data.get('jobs', 1),
+        cache=config_data.get('cache') or None,
+        sort_buffer_size=config_data.get('sort_buffer_size', 64 * 1024 * 1024),
+        recursive=config_data.get('recursive', False),
+        include=config_data.get('include'),
+        exclude=config_data.get('exclude'),
+        yaml_backend=config_data.get('yaml_backend', 'yamlreader'),
+        statsfile=config_data.get('stats'),
+        index_output=config_data.get('index_output'),
+        log_format=config_data.get('log_format', 'text'),
+        io_concurrency=config_data.get('io_concurrency', 1),
+        shard_by=config_data.get('shard_by'),
+        shard_filename=config_data.get('shard_filename'),
+        combined=config_data.get('combined', True),
+        delta_output=config_data.get('delta_output'),
+        delta_summary=config_data.get('delta_summary'),
+        delta_base=config_data.get('delta_base'),
+        hierarchy=config_data.get('hierarchy'),
+        hieradata=config_data.get('hieradata'),
+        profile=config_data.get('profile'),
+        targets=config_data.get('targets'),
+        include_attributes=config_data.get('include_attributes'),
+        exclude_attributes=config_data.get('exclude_attributes'),
+        max_depth=config_data.get('max_depth')
     )
-    genders_generator.generate_genders_file()
+    if config_data.get('watch'):
+        watcher = GendersWatcher(
+            genders_generator,
+            config_data.get('debounce', 2.0),
+            config_data.get('poll_interval', 10.0)
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.stop()
+    else:
+        try:
+            changed = genders_generator.generate_genders_file()
+        finally:
+            if config_data.get('profile'):
+                sys.stderr.write(genders_generator.stats.get_host_report(
+                    config_data.get('profile_top', 10)) + "\n")
+        if not changed:
+            sys.exit(config_data.get('unchanged_exit_status', 0))
 
 
 if __name__ == '__main__':
@@ -1,12 +1,26 @@
 # coding=utf-8
+import copy
+import io
+import json
+import os
 import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import yaml
+import zipfile
 import logging
 import unittest2 as unittest
 from os.path import join
-from generate_hostlist import GenerateGenders
-from mock import patch
+from generate_hostlist import (AttributeProjection, GenerateGenders, GendersDelta, GendersIndex, GendersQueryError,
+                               GendersTarget, GendersWatcher, HostfileSourceError, HostRecord,
+                               SymbolTable, apply_genders_delta, apply_genders_delta_file,
+                               render_gender_entries, sort_entries)
+from mock import Mock, patch
 from testfixtures import log_capture
 
 
@@ -36,10 +50,16 @@ class TestGenerateGenders(unittest.TestCase):
             ".yaml",
         ]
 
-    def __mock_isfile(self, filename):
-        if filename.endswith("this.is.a.directory.yaml"):
-            return False
-        return True
+    def __mock_scandir(self, directory):
+        entries = []
+        for filename in ["%s.yaml" % host for host in self.expected_hosts.keys()] + self.added_filelist:
+            entry = Mock()
+            entry.name = filename
+            entry.path = join(directory, filename)
+            entry.is_file.return_value = not filename.endswith("this.is.a.directory.yaml")
+            entry.is_dir.return_value = filename.endswith("this.is.a.directory.yaml")
+            entries.append(entry)
+        return entries
 
     @log_capture()
     def test_logging_works(self, logcapture):
@@ -60,11 +80,46 @@ class TestGenerateGenders(unittest.TestCase):
             ('generate_hostlist', 'CRITICAL', 'Critical message'),
         )
 
+    def test_logger_handler_is_added_once(self):
+        for log_format in ['text', 'json', 'text']:
+            GenerateGenders(inputdirectories={}, domainconfig={}, gendersfile="",
+                            log_format=log_format)
+        handlers = [handler for handler in logging.getLogger('generate_hostlist').handlers
+                    if isinstance(handler, logging.StreamHandler)]
+        self.assertEqual(len(handlers), 1)
+
+    def test_json_log_format(self):
+        generator = GenerateGenders(inputdirectories={}, domainconfig={}, gendersfile="",
+                                    log_format='json')
+        try:
+            handler = [handler for handler in generator.log.handlers
+                       if getattr(handler, 'generate_hostlist', False)][0]
+            record = generator.log.makeRecord('generate_hostlist', logging.WARNING, __file__, 1,
+                                              "Hostfile '%s' broken", ('a.yaml',), None)
+            self.assertEqual(json.loads(handler.format(record))['message'],
+                             "Hostfile 'a.yaml' broken")
+            self.assertEqual(json.loads(handler.format(record))['level'], 'WARNING')
+        finally:
+            GenerateGenders(inputdirectories={}, domainconfig={}, gendersfile="")
+
+    def test_log_arguments_are_formatted_lazily(self):
+        class Unformattable(object):
+            def __str__(self):
+                raise AssertionError("formatted although the level is disabled")
+        self.genders_creator.debug("Found host '%s'", Unformattable())
+
+    @patch('generate_hostlist._scandir')
+    def test_get_all_hosts_from_directory_returns_hosts(self, scandir_mock):
+        scandir_mock.side_effect = self.__mock_scandir
+        hostlist = self.genders_creator.get_all_hosts_from_directory("foobar")
+        self.assertItemsEqual(hostlist, self.expected_hosts.keys())
+
+    @patch('generate_hostlist.scandir', None)
     @patch('generate_hostlist.listdir')
     @patch('generate_hostlist.isfile')
-    def test_get_all_hosts_from_directory_returns_hosts(self, isfile_mock, listdir_mock):
+    def test_get_all_hosts_from_directory_without_scandir(self, isfile_mock, listdir_mock):
         listdir_mock.return_value = ["%s.yaml" % host for host in self.expected_hosts.keys()] + self.added_filelist
-        isfile_mock.side_effect = self.__mock_isfile
+        isfile_mock.side_effect = lambda filename: not filename.endswith("this.is.a.directory.yaml")
         hostlist = self.genders_creator.get_all_hosts_from_directory("foobar")
         self.assertItemsEqual(hostlist, self.expected_hosts.keys())
 
@@ -100,6 +155,27 @@ class TestGenerateGenders(unittest.TestCase):
             "Could not get attributes from hostname 'foobar.invalid'. No matching config found."
         ))
 
+    def test_get_attributes_from_longest_matching_domain(self):
+        self.genders_creator.domainconfig = {
+            'test': '^(?P<hostgroup>.*?)-?\d*\.(?P<subdomain>[^.]*)\.(?P<domain>[^.]*)$',
+            'special.test': '^(?P<special>.*?)\.special\.test$',
+            'st': '^(?P<never>.*)$',
+        }
+        self.assertEqual(
+            self.genders_creator.get_attributes_from_hostname("hostname-20.special.test"),
+            {'special': 'hostname-20'}
+        )
+        self.assertEqual(
+            self.genders_creator.get_attributes_from_hostname("hostname-20.testsub.test"),
+            self.expected_hosts["hostname-20.testsub.test"]
+        )
+
+    def test_classify_hostnames(self):
+        self.assertEqual(
+            self.genders_creator.classify_hostnames(iter(self.expected_hosts.keys())),
+            self.expected_hosts
+        )
+
     @patch('generate_hostlist.GenerateGenders.get_attributes_from_hostname')
     @patch('generate_hostlist.GenerateGenders.get_config_from_file')
     def template_test_get_gender_entry(self, return_file_config, return_hostname_config, expected_entry, mock_file_config, mock_hostname_config):
@@ -149,6 +225,182 @@ class TestGenerateGenders(unittest.TestCase):
         expected_entry = "foobar.invalid	bar=komma_gleichheitszeichen_sind__böse,foo=Mit_Leerzeichen,source=Mock"
         self.template_test_get_gender_entry(file_config, hostname_config, expected_entry)
 
+    def test_get_gender_nested_values(self):
+        file_config = {'packages': [u'vim', 2, {u'b': 1, u'a': [True]}],
+                       'settings': {u'z': u'last', u'a': {u'y': 1, u'x': None}}}
+        expected_entry = (u"foobar.invalid\tpackages=[u'vim'__2__{u'a':_[True]__u'b':_1}],"
+                          u"settings={u'a':_{u'x':_None__u'y':_1}__u'z':_u'last'},source=Mock")
+        self.template_test_get_gender_entry(file_config, {}, expected_entry)
+
+    def test_render_gender_entries(self):
+        hosts = [(u"host%02d" % number, "src", {'role': u'web server', 'id': number % 3})
+                 for number in range(10)]
+        self.assertEqual(render_gender_entries(hosts),
+                         [u"host%02d\tid=%s,role=web_server,source=src" % (number, number % 3)
+                          for number in range(10)])
+
+
+class TestSortEntries(unittest.TestCase):
+    def test_sort_entries_in_memory(self):
+        entries = [u"c", u"a", u"b"]
+        self.assertEqual(list(sort_entries(iter(entries), None)), sorted(entries))
+
+    def test_sort_entries_with_temporary_files(self):
+        entries = [u"host%03d\tcomment=%s" % (number * 7 % 100, u"\u00e4\\n\n" * (number % 3))
+                   for number in range(100)]
+        self.assertEqual(list(sort_entries(iter(entries), 200)), sorted(entries))
+
+    def test_sort_entries_merges_with_bounded_fan_in(self):
+        entries = [u"host%04d" % (number * 7919 % 1000) for number in range(1000)]
+        for fan_in in [2, 3, 64]:
+            self.assertEqual(list(sort_entries(iter(entries), 100, fan_in=fan_in)),
+                             sorted(entries))
+
+    def test_sort_host_records_with_temporary_files(self):
+        entries = [u"host%03d.invalid\tcomment=%s" % (number * 7 % 100, u"\u00e4" * (number % 3))
+                   for number in range(100)] + [u"host001\tshort"]
+        records = sort_entries((HostRecord.parse(entry) for entry in entries), 200,
+                               dump=HostRecord.render, load=HostRecord.parse)
+        self.assertEqual([record.render() for record in records], sorted(entries))
+
+
+class TestAttributeProjection(unittest.TestCase):
+    document = b"""
+defaults: &defaults
+  owner: ops
+  packages: [vim, git]
+role: web
+packages: [vim, git]
+settings: {network: {mtu: 1500}, ntp: pool}
+inherited: *defaults
+certificate: |
+  -----BEGIN CERTIFICATE-----
+<<: {merged: 1, secret: 2}
+"""
+
+    def assert_projection(self, projection, expected):
+        loaders = [yaml.SafeLoader] + ([yaml.CSafeLoader] if hasattr(yaml, 'CSafeLoader') else [])
+        for loader in loaders:
+            self.assertEqual(projection.load_yaml(io.BytesIO(self.document), loader), expected)
+            self.assertEqual(projection.apply(yaml.load(io.BytesIO(self.document), loader)),
+                             expected)
+
+    def test_keys(self):
+        self.assert_projection(
+            AttributeProjection(include=['r*', 'inherited', 'merged', 'secret'],
+                                exclude=['secret']),
+            {'role': 'web', 'inherited': {'owner': 'ops', 'packages': ['vim', 'git']},
+             'merged': 1})
+
+    def test_max_depth(self):
+        self.assert_projection(
+            AttributeProjection(exclude=['defaults', 'certificate'], max_depth=0),
+            {'role': 'web', 'merged': 1, 'secret': 2})
+        self.assert_projection(
+            AttributeProjection(exclude=['defaults', 'certificate'], max_depth=1),
+            {'role': 'web', 'packages': ['vim', 'git'], 'settings': {'ntp': 'pool'},
+             'inherited': {'owner': 'ops'}, 'merged': 1, 'secret': 2})
+
+
+class TestHostRecord(unittest.TestCase):
+    def test_parse_and_render(self):
+        record = HostRecord.parse(u"db01.invalid\trole=db,source=dc1")
+        self.assertEqual(record.hostname, u"db01.invalid")
+        self.assertEqual(record.attributes, u"role=db,source=dc1")
+        self.assertEqual(record.render(), u"db01.invalid\trole=db,source=dc1")
+
+    def test_parse_without_attributes(self):
+        self.assertEqual(HostRecord.parse(u"db01.invalid\t"), (u"db01.invalid", ()))
+
+    def test_symbol_table_shares_attributes(self):
+        symbols = SymbolTable()
+        first = symbols.intern_record(HostRecord(u"db01", (u"backup", u"role=db")))
+        second = symbols.intern_record(HostRecord.parse(u"db02\tbackup,role=" + u"db"))
+        self.assertIs(first[1][1], second[1][1])
+        self.assertEqual(symbols.get_tokens(first[1]),
+                         [(u"backup", u"backup"), (u"role=db", u"role")])
+
+    def test_bounded_symbol_table_is_cleared_when_full(self):
+        symbols = SymbolTable(2)
+        for number in range(10):
+            record = symbols.intern_record(HostRecord(u"db01", (u"role=db%d" % number,)))
+            symbols.get_tokens(record[1])
+        self.assertLessEqual(len(symbols), 2)
+        self.assertLessEqual(len(symbols.keys), 2)
+
+    def test_host_record_size_includes_attributes(self):
+        short = HostRecord(u"db01", (u"role=db",))
+        long_ = HostRecord(u"db01", (u"role=db",) * 100)
+        self.assertGreater(sys.getsizeof(long_), sys.getsizeof(short) + 700)
+
+
+class TestGendersIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = GendersIndex()
+        for entry in [
+            u"db01.invalid\trole=db,stage=prod,source=dc1",
+            u"db02.invalid\trole=db,stage=test,source=dc1,backup",
+            u"web-01.invalid\trole=web-server,stage=prod,source=dc2",
+            u"web-02.invalid\trole=web-server,stage=test,source=dc2,backup",
+        ]:
+            self.index.add_entry(entry)
+
+    def test_query(self):
+        for (expression, expected) in [
+            ("role=db", ["db01.invalid", "db02.invalid"]),
+            ("backup", ["db02.invalid", "web-02.invalid"]),
+            ("role=db&&stage=prod", ["db01.invalid"]),
+            ("role=db || role=web-server&&stage=prod", ["db01.invalid", "db02.invalid", "web-01.invalid"]),
+            ("(role=db||role=web-server)&&stage=prod", ["db01.invalid", "web-01.invalid"]),
+            ("source=dc2--backup", ["web-01.invalid"]),
+            ("~backup", ["db01.invalid", "web-01.invalid"]),
+            ("~(stage=prod||backup)", []),
+            ("role=unknown", []),
+        ]:
+            self.assertEqual(self.index.query(expression), expected, msg=expression)
+
+    def test_malformed_queries(self):
+        for expression in ["", "role=db&&", "(role=db", "role=db)", "&&role=db"]:
+            with self.assertRaises(GendersQueryError):
+                self.index.query(expression)
+
+    def test_bounded_symbol_table_keeps_bare_attributes(self):
+        index = GendersIndex(SymbolTable(2))
+        index.add_entry(u"db01.invalid\tbackup,role=db")
+        index.add_entry(u"db02.invalid\tbackup,role=db")
+        self.assertNotIn(u"backup", index.values)
+        self.assertEqual(index.query("backup"), ["db01.invalid", "db02.invalid"])
+        self.assertEqual(index.query("role=db"), ["db01.invalid", "db02.invalid"])
+
+
+class TestGendersDelta(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_delta_roundtrip(self):
+        old = [b"a\tx=1", b"b\tx=1", b"b\ty=1", b"c\tx=1", b"d\tx=1"]
+        new = [b"a\tx=1", b"b\ty=1", b"b\tz=1", b"c\tx=2", b"e\tx=1"]
+        with open(join(self.test_dir, 'old'), 'wb') as f:
+            f.write(b"\n".join(old))
+        delta = GendersDelta(join(self.test_dir, 'old'), join(self.test_dir, 'patch'))
+        for line in new:
+            delta.add_line(line)
+        summary = delta.close()
+        self.assertEqual((summary['added_hosts'], summary['removed_hosts'],
+                          summary['changed_hosts'], summary['unchanged']),
+                         ([u'e'], [u'd'], [u'b', u'c'], 2))
+        with open(join(self.test_dir, 'patch'), 'rb') as f:
+            patch_lines = f.read().split(b"\n")
+        self.assertEqual(patch_lines, [GendersDelta.HEADER, b"=1", b"-b\tx=1", b"=1",
+                                       b"+b\tz=1", b"-c\tx=1", b"+c\tx=2", b"-d\tx=1",
+                                       b"+e\tx=1"])
+        self.assertEqual(list(apply_genders_delta(old, patch_lines)), new)
+        with self.assertRaises(ValueError):
+            list(apply_genders_delta(old[1:], patch_lines))
+
 
 class TestGenerateGendersWithFiles(unittest.TestCase):
     def setUp(self):
@@ -201,6 +453,157 @@ class TestGenerateGendersWithFiles(unittest.TestCase):
             "Hostfile '{0}' not a proper YAML-File: YAML Error: while scanning a quoted scalar\n  in \"{0}\", line 1, column 7\nfound unexpected end of stream\n  in \"{0}\", line 1, column 14".format(filename)
         ))
 
+    @patch('generate_hostlist.yaml_load')
+    def test_get_config_from_file_reads_hostfile_once_with_yamlreader(self, yaml_load_mock):
+        filename = join(self.test_dir, 'test.yaml')
+        with open(filename, 'w') as f:
+            f.write("role: foobar")
+        self.assertEqual(self.genders_creator.get_config_from_file(filename), {'role': 'foobar'})
+        self.assertFalse(yaml_load_mock.called)
+
+    def test_get_proper_data_from_file_with_all_backends(self):
+        data = {'role': 'foobar', 'kostenstelle': 9876, 'packages': ['a', 'b']}
+        yaml_filename = join(self.test_dir, 'test.yaml')
+        with open(yaml_filename, 'w') as f:
+            f.write(yaml.dump(data, default_flow_style=False))
+        json_filename = join(self.test_dir, 'test.json')
+        with open(json_filename, 'w') as f:
+            f.write(json.dumps(data))
+        for backend in ['auto', 'c', 'python', 'yamlreader']:
+            self.genders_creator.yaml_backend = backend
+            self.assertEqual(self.genders_creator.get_config_from_file(yaml_filename), data)
+            if backend != 'yamlreader':
+                self.assertEqual(self.genders_creator.get_config_from_file(json_filename), data)
+
+    def test_generate_genders_file_with_io_concurrency(self):
+        for number in range(20):
+            with open(join(self.test_dir, 'hostname%02d.stage01.invalid.yaml' % number), 'w') as f:
+                f.write("role: foobar\nnumber: %s" % number)
+        with open(join(self.test_dir, 'broken.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: 'Foobar")
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+        for backend in ['python', 'yamlreader']:
+            self.genders_creator.yaml_backend = backend
+            self.genders_creator.io_concurrency = 1
+            self.genders_creator.generate_genders_file()
+            with open(self.gendersfile) as f:
+                expected = f.read()
+            self.genders_creator.io_concurrency = 4
+            self.genders_creator.generate_genders_file()
+            with open(self.gendersfile) as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(self.genders_creator.stats.counters['parse_failures'], 1)
+
+    def create_git_repository(self):
+        repository = join(self.test_dir, 'hieradata')
+        os.makedirs(join(repository, 'hosts', 'sub'))
+        for (filename, content) in [('hosts/hostname01.stage01.invalid.yaml', "role: foobar"),
+                                    ('hosts/sub/hostname02.stage02.invalid.yaml', "role: sub"),
+                                    ('hosts/hostname03.stage01.invalid.yaml', "role: 'broken"),
+                                    ('other.stage01.invalid.yaml', "role: other")]:
+            with open(join(repository, filename), 'w') as f:
+                f.write(content)
+        for command in [['init', '-q'], ['add', '.'], ['commit', '-q', '-m', 'hosts']]:
+            subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@invalid']
+                                  + command, cwd=repository)
+        shutil.rmtree(join(repository, 'hosts'))
+        return repository
+
+    @log_capture('generate_hostlist', level=logging.WARNING)
+    def test_generate_genders_file_from_git_source(self, logcapture):
+        repository = self.create_git_repository()
+        self.genders_creator.inputdirectories = {'git': 'git:%s@HEAD:hosts' % repository}
+        self.genders_creator.recursive = True
+        self.genders_creator.cache = True
+        for jobs in [1, 2, 1]:
+            self.genders_creator.jobs = jobs
+            self.genders_creator.generate_genders_file()
+            with open(self.gendersfile) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "hostname01.stage01.invalid\thostgroup=hostname,role=foobar,source=git,"
+                    "stage=01",
+                    "hostname02.stage02.invalid\thostgroup=hostname,role=sub,source=git,"
+                    "stage=02",
+                    "hostname03.stage01.invalid\thostgroup=hostname,source=git,stage=01",
+                ])
+        self.assertEqual(self.genders_creator.stats.counters['cache_hits'], 3)
+        self.assertIn("Hostfile 'git:%s@HEAD:hosts/hostname03.stage01.invalid.yaml' not a proper "
+                      "YAML-File" % repository, logcapture.records[0].getMessage())
+
+    def test_generate_genders_file_from_archives(self):
+        hostfiles = [('hostname01.stage01.invalid.yaml', b"role: foobar"),
+                     ('./sub/hostname02.stage02.invalid.yaml', b"role: sub"),
+                     ('.hidden/hostname03.stage02.invalid.yaml', b"role: hidden"),
+                     ('README', b"not a hostfile")]
+        tar_filename = join(self.test_dir, 'hosts.tar.gz')
+        with tarfile.open(tar_filename, 'w:gz') as archive:
+            for (name, content) in hostfiles:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        zip_filename = join(self.test_dir, 'hosts.zip')
+        with zipfile.ZipFile(zip_filename, 'w') as archive:
+            for (name, content) in hostfiles:
+                archive.writestr(name, content)
+        self.genders_creator.recursive = True
+        self.genders_creator.cache = True
+        for filename in [tar_filename, zip_filename]:
+            self.genders_creator.inputdirectories = {'archive': filename}
+            for jobs in [1, 2]:
+                self.genders_creator.jobs = jobs
+                self.genders_creator.generate_genders_file()
+                with open(self.gendersfile) as f:
+                    self.assertEqual(f.read().splitlines(), [
+                        "hostname01.stage01.invalid\thostgroup=hostname,role=foobar,"
+                        "source=archive,stage=01",
+                        "hostname02.stage02.invalid\thostgroup=hostname,role=sub,"
+                        "source=archive,stage=02",
+                    ])
+                self.assertEqual(self.genders_creator._GenerateGenders__blob_sources, {})
+            self.assertEqual(self.genders_creator.stats.counters['cache_hits'], 2)
+
+    @log_capture('generate_hostlist', level=logging.CRITICAL)
+    def test_generate_genders_file_reports_unreadable_sources(self, logcapture):
+        broken_archive = join(self.test_dir, 'broken.tar.gz')
+        with open(broken_archive, 'wb') as f:
+            f.write(b"not an archive")
+        for path in [join(self.test_dir, 'missing'), broken_archive]:
+            self.genders_creator.inputdirectories = {'broken': path}
+            with self.assertRaises(HostfileSourceError):
+                self.genders_creator.generate_genders_file()
+        self.assertEqual([record.getMessage().split(':')[0] for record in logcapture.records],
+                         ["Cannot read hostfiles"] * 2)
+        self.assertFalse(os.path.exists(self.gendersfile))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            self.genders_creator.yaml_backend = 'unknown'
+
+    @log_capture('generate_hostlist', level=logging.WARNING)
+    def test_get_no_data_from_incorrect_file_with_python_backend(self, logcapture):
+        filename = join(self.test_dir, 'test.yaml')
+        with open(filename, 'w') as f:
+            f.write("role: 'Foobar")
+        self.genders_creator.yaml_backend = 'python'
+        self.assertEqual(self.genders_creator.get_config_from_file(filename), {})
+        logcapture.check((
+            'generate_hostlist',
+            'WARNING',
+            "Hostfile '{0}' not a proper YAML-File: YAML Error: while scanning a quoted scalar\n  in \"{0}\", line 1, column 7\nfound unexpected end of stream\n  in \"{0}\", line 1, column 14".format(filename)
+        ))
+
+    def test_get_host_tasks_with_json_hostfiles(self):
+        for filename in ['host1.invalid.yaml', 'host2.invalid.json']:
+            with open(join(self.test_dir, filename), 'w') as f:
+                f.write('{"role": "foobar"}')
+        self.assertEqual([task.filename for task in self.genders_creator.get_host_tasks()],
+                         ['host1.invalid.yaml'])
+        self.genders_creator.yaml_backend = 'auto'
+        self.assertItemsEqual(
+            [(task.hostname, task.filename) for task in self.genders_creator.get_host_tasks()],
+            [('host1.invalid', 'host1.invalid.yaml'), ('host2.invalid', 'host2.invalid.json')]
+        )
+
     @log_capture(level=logging.WARNING)
     def test_get_no_data_from_nonexisting_file(self, logcapture):
         filename = join(self.test_dir, 'nonexistent.yaml')
@@ -252,3 +655,565 @@ class TestGenerateGendersWithFiles(unittest.TestCase):
             self.fail("No gendersfile written")
         self.maxDiff = None
         self.assertEqual(gendersfile_content, "\n".join(expected_gendersfile))
+
+    def write_role_hostfiles(self, hosts, directory=None):
+        for (hostname, role) in hosts:
+            with open(join(directory or self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: %s" % role)
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+
+    def write_stats_test_files(self):
+        for hostname in ['hostname01.stage01.invalid', 'broken.invalid', 'unknown.example']:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: 'Foobar" if hostname == 'broken.invalid' else "role: foobar")
+
+    def assert_stats(self, stats):
+        self.assertEqual(stats['counters']['files_scanned'], 3)
+        self.assertEqual(stats['counters']['files_parsed'], 3)
+        self.assertEqual(stats['counters']['parse_failures'], 1)
+        self.assertEqual(stats['counters']['unmatched_hostnames'], 2)
+        self.assertEqual(stats['counters']['entries_written'], 3)
+        self.assertEqual(stats['counters']['bytes_written'], os.stat(self.gendersfile).st_size)
+        self.assertGreater(stats['peak_rss_bytes'], 0)
+        for phase in ['discovery', 'sorting', 'writing']:
+            self.assertGreaterEqual(stats['phases'][phase]['wall_seconds'], 0)
+            self.assertGreaterEqual(stats['phases'][phase]['cpu_seconds'], 0)
+        self.assertNotIn('hostname_parsing', stats['phases'])
+
+    def test_generate_genders_file_collects_stats(self):
+        self.write_stats_test_files()
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+        self.genders_creator.statsfile = join(self.test_dir, 'stats.json')
+        self.genders_creator.generate_genders_file()
+        self.assert_stats(self.genders_creator.stats.as_dict())
+        with open(self.genders_creator.statsfile) as f:
+            self.assert_stats(json.load(f))
+
+    def test_generate_genders_file_collects_stats_with_jobs(self):
+        self.write_stats_test_files()
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+        self.genders_creator.jobs = 2
+        self.genders_creator.generate_genders_file()
+        self.assert_stats(self.genders_creator.stats.as_dict())
+
+    def test_generate_genders_file_writes_prometheus_stats(self):
+        self.write_stats_test_files()
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+        self.genders_creator.statsfile = join(self.test_dir, 'genders.prom')
+        self.genders_creator.generate_genders_file()
+        with open(self.genders_creator.statsfile) as f:
+            metrics = f.read().splitlines()
+        self.assertIn('# TYPE generate_hostlist_parse_failures gauge', metrics)
+        self.assertIn('generate_hostlist_parse_failures 1', metrics)
+        self.assertTrue([metric for metric in metrics
+                         if metric.startswith('generate_hostlist_phase_wall_seconds{phase="writing"} ')])
+
+    def test_generate_genders_file_with_jobs(self):
+        for number in range(20):
+            filename = join(self.test_dir, 'hostname%02d.stage%02d.invalid.yaml' % (number, number % 3))
+            with open(filename, 'w') as f:
+                f.write(yaml.dump({'role': 'role%s' % (number % 4), 'number': number},
+                                  default_flow_style=False))
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile, 'r') as f:
+            serial_content = f.read()
+        parallel_creator = GenerateGenders(
+            inputdirectories={"TestDir": self.test_dir},
+            domainconfig=self.genders_creator.domainconfig,
+            gendersfile=self.gendersfile,
+            jobs=3
+        )
+        parallel_creator.generate_genders_file()
+        with open(self.gendersfile, 'r') as f:
+            self.assertEqual(f.read(), serial_content)
+
+    @log_capture('generate_hostlist', level=logging.WARNING)
+    def test_generate_genders_file_with_jobs_keeps_warnings(self, logcapture):
+        for hostname in ['hostname01.stage01.invalid', 'broken.invalid', 'unknown.example']:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: 'Foobar" if hostname == 'broken.invalid' else "role: foobar")
+        self.genders_creator.jobs = 2
+        self.genders_creator.generate_genders_file()
+        messages = [record.getMessage() for record in logcapture.records]
+        self.assertIn("Hostname 'broken.invalid' does not match the Regex "
+                      "'(?P<hostgroup>.*?)[0-9]+\\.stage(?P<stage>[0-9]*)\\.invalid'", messages)
+        self.assertIn("Could not get attributes from hostname 'unknown.example'. "
+                      "No matching config found.", messages)
+        self.assertTrue([message for message in messages
+                         if message.startswith("Hostfile '%s' not a proper YAML-File"
+                                               % join(self.test_dir, 'broken.invalid.yaml'))])
+
+    def test_generate_genders_file_with_cache(self):
+        cachefile = join(self.test_dir, 'cache.json')
+        for hostname in ['hostname01.stage01.invalid', 'hostname02.stage01.invalid']:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: foobar")
+        self.genders_creator.cache = cachefile
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile, 'r') as f:
+            uncached_content = f.read()
+        with patch('generate_hostlist.GenerateGenders.get_config_from_file') as mock_file_config:
+            self.genders_creator.generate_genders_file()
+            self.assertFalse(mock_file_config.called)
+        with open(self.gendersfile, 'r') as f:
+            self.assertEqual(f.read(), uncached_content)
+
+        os.remove(join(self.test_dir, 'hostname02.stage01.invalid.yaml'))
+        self.genders_creator.generate_genders_file()
+        with open(cachefile, 'r') as f:
+            self.assertEqual(len(json.load(f)['entries']), 1)
+
+        self.genders_creator.domainconfig = {'invalid': '(?P<hostgroup>.*?)[0-9]+\.'}
+        with patch('generate_hostlist.GenerateGenders.get_config_from_file') as mock_file_config:
+            mock_file_config.return_value = {}
+            self.genders_creator.generate_genders_file()
+            self.assertTrue(mock_file_config.called)
+
+    def test_generate_genders_file_with_cache_and_jobs(self):
+        for hostname in ['hostname01.stage01.invalid', 'hostname02.stage01.invalid']:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: foobar")
+        self.genders_creator.cache = join(self.test_dir, 'cache.json')
+        self.genders_creator.jobs = 2
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile, 'r') as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+    def test_generate_genders_file_replaces_file_atomically(self):
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: foobar")
+        with open(self.gendersfile, 'w') as f:
+            f.write("old content")
+        os.chmod(self.gendersfile, 0o640)
+        self.genders_creator.sort_buffer_size = 1
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile, 'r') as f:
+            self.assertEqual(
+                f.read(),
+                "hostname01.stage01.invalid\thostgroup=hostname,role=foobar,source=TestDir,stage=01"
+            )
+        self.assertEqual(os.stat(self.gendersfile).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['gendersfile', 'hostname01.stage01.invalid.yaml'])
+
+    def test_generate_genders_file_writes_through_symlink(self):
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: foobar")
+        os.mkdir(join(self.test_dir, 'etc'))
+        target = join(self.test_dir, 'etc', 'genders.real')
+        with open(target, 'w') as f:
+            f.write("old content")
+        os.symlink(target, self.gendersfile)
+        self.genders_creator.generate_genders_file()
+        self.assertTrue(os.path.islink(self.gendersfile))
+        with open(target, 'r') as f:
+            self.assertEqual(
+                f.read(),
+                "hostname01.stage01.invalid\thostgroup=hostname,role=foobar,source=TestDir,stage=01"
+            )
+        self.assertEqual(os.listdir(join(self.test_dir, 'etc')), ['genders.real'])
+
+    def test_get_host_tasks_recursive(self):
+        for subdirectory in ['dc1', join('dc2', 'rack1'), join('dc2', 'old'), '.git']:
+            os.makedirs(join(self.test_dir, subdirectory))
+            with open(join(self.test_dir, subdirectory, 'host-%s.invalid.yaml' % len(subdirectory)), 'w') as f:
+                f.write("role: foobar")
+        with open(join(self.test_dir, 'top.invalid.yaml'), 'w') as f:
+            f.write("role: foobar")
+        self.assertEqual([task.hostname for task in self.genders_creator.get_host_tasks()],
+                         ['top.invalid'])
+        self.genders_creator.recursive = True
+        self.genders_creator.exclude = ['dc2/old']
+        self.assertItemsEqual(
+            [(task.directory_path, task.hostname) for task in self.genders_creator.get_host_tasks()],
+            [(self.test_dir, 'top.invalid'),
+             (join(self.test_dir, 'dc1'), 'host-3.invalid'),
+             (join(self.test_dir, 'dc2', 'rack1'), 'host-9.invalid')]
+        )
+        self.genders_creator.include = ['dc*/*']
+        self.assertItemsEqual(
+            [task.hostname for task in self.genders_creator.get_host_tasks()],
+            ['host-3.invalid', 'host-9.invalid']
+        )
+
+    def test_generate_genders_file_builds_index(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'foobar'),
+                                   ('hostname03.stage02.invalid', 'mailserver')])
+        self.genders_creator.build_index = True
+        self.genders_creator.generate_genders_file()
+        self.assertEqual(len(self.genders_creator.hosts), 3)
+        self.assertEqual(self.genders_creator.query("role=foobar&&stage=02"),
+                         ['hostname02.stage02.invalid'])
+        self.assertEqual(GendersIndex.from_file(self.gendersfile).query("role=foobar"),
+                         ['hostname01.stage01.invalid', 'hostname02.stage02.invalid'])
+
+    def test_generate_genders_file_keeps_unchanged_file(self):
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: foobar")
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        os.utime(self.gendersfile, (1000000000, 1000000000))
+        inode = os.stat(self.gendersfile).st_ino
+        self.assertFalse(self.genders_creator.generate_genders_file())
+        self.assertEqual(self.genders_creator.stats.counters['gendersfile_changed'], 0)
+        self.assertEqual(os.stat(self.gendersfile).st_mtime, 1000000000)
+        self.assertEqual(os.stat(self.gendersfile).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['gendersfile', 'hostname01.stage01.invalid.yaml'])
+
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: changed")
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertEqual(self.genders_creator.stats.counters['gendersfile_changed'], 1)
+        self.assertNotEqual(os.stat(self.gendersfile).st_mtime, 1000000000)
+
+    def test_generate_genders_file_writes_shards(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'foobar'),
+                                   ('hostname03.stage02.invalid', 'mail/server'),
+                                   ('nostage.invalid', 'foobar')])
+        self.genders_creator.shard_by = 'role'
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        with open(self.gendersfile) as f:
+            lines = f.read().split('\n')
+        with open(self.gendersfile + '.foobar') as f:
+            self.assertEqual(f.read().split('\n'), [lines[0], lines[1], lines[3]])
+        with open(self.gendersfile + '.mail_server') as f:
+            self.assertEqual(f.read().split('\n'), [lines[2]])
+        self.assertEqual(self.genders_creator.stats.counters['shards_changed'], 2)
+        self.genders_creator.combined = False
+        self.genders_creator.shard_filename = join(self.test_dir, 'shards', 'genders.{shard}')
+        os.mkdir(join(self.test_dir, 'shards'))
+        os.unlink(self.gendersfile)
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertFalse(os.path.exists(self.gendersfile))
+        self.assertEqual(sorted(os.listdir(join(self.test_dir, 'shards'))),
+                         ['genders.foobar', 'genders.mail_server'])
+        self.assertFalse(self.genders_creator.generate_genders_file())
+
+    def test_generate_genders_file_writes_many_shards_with_few_writers(self):
+        for number in range(20):
+            with open(join(self.test_dir, 'host%02d.invalid.yaml' % number), 'w') as f:
+                f.write("role: role%d" % (number % 10))
+        self.genders_creator.log.setLevel(logging.CRITICAL)
+        self.genders_creator.shard_by = 'role'
+        self.genders_creator.shard_filename = join(self.test_dir, 'shards', 'genders.{shard}')
+        self.genders_creator.sort_buffer_size = 1
+        self.genders_creator.SHARD_WRITERS = 2
+        os.mkdir(join(self.test_dir, 'shards'))
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertEqual(self.genders_creator.stats.counters['shards_written'], 10)
+        self.assertEqual(sorted(os.listdir(join(self.test_dir, 'shards'))),
+                         ['genders.role%d' % number for number in range(10)])
+        with open(join(self.test_dir, 'shards', 'genders.role3')) as f:
+            self.assertEqual(f.read(), "host03.invalid\trole=role3,source=TestDir\n"
+                                       "host13.invalid\trole=role3,source=TestDir")
+        self.assertEqual(len(os.listdir(self.test_dir)), 23)
+
+    def test_generate_genders_file_removes_stale_shards(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'mail')])
+        self.genders_creator.shard_by = 'role'
+        with open(self.gendersfile + '.unrelated', 'w') as f:
+            f.write("not a shard")
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertTrue(os.path.exists(self.gendersfile + '.mail'))
+        with open(join(self.test_dir, 'hostname02.stage02.invalid.yaml'), 'w') as f:
+            f.write("stage: stage02")
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertFalse(os.path.exists(self.gendersfile + '.mail'))
+        self.assertTrue(os.path.exists(self.gendersfile + '.foobar'))
+        self.assertTrue(os.path.exists(self.gendersfile + '.unrelated'))
+        self.assertEqual(self.genders_creator.stats.counters['shards_removed'], 1)
+        os.unlink(join(self.test_dir, 'hostname01.stage01.invalid.yaml'))
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        self.assertFalse(os.path.exists(self.gendersfile + '.foobar'))
+
+    def test_generate_genders_file_writes_delta(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'foobar')])
+        self.genders_creator.generate_genders_file()
+        shutil.copy(self.gendersfile, join(self.test_dir, 'genders.old'))
+        os.unlink(join(self.test_dir, 'hostname01.stage01.invalid.yaml'))
+        with open(join(self.test_dir, 'hostname02.stage02.invalid.yaml'), 'w') as f:
+            f.write("role: \u00e4")
+        with open(join(self.test_dir, 'hostname03.stage02.invalid.yaml'), 'w') as f:
+            f.write("role: mailserver")
+        self.genders_creator.delta_output = join(self.test_dir, 'genders.patch')
+        self.genders_creator.delta_summary = join(self.test_dir, 'genders.json')
+        self.assertTrue(self.genders_creator.generate_genders_file())
+        with open(join(self.test_dir, 'genders.json')) as f:
+            summary = json.load(f)
+        self.assertEqual((summary['added_hosts'], summary['removed_hosts'],
+                          summary['changed_hosts']),
+                         ([u'hostname03.stage02.invalid'], [u'hostname01.stage01.invalid'],
+                          [u'hostname02.stage02.invalid']))
+        self.assertEqual(self.genders_creator.stats.counters['hosts_changed'], 1)
+        self.assertTrue(apply_genders_delta_file(join(self.test_dir, 'genders.old'),
+                                                 join(self.test_dir, 'genders.patch'),
+                                                 join(self.test_dir, 'genders.new')))
+        with open(self.gendersfile, 'rb') as expected, \
+                open(join(self.test_dir, 'genders.new'), 'rb') as result:
+            self.assertEqual(result.read(), expected.read())
+
+    def test_get_host_record_merges_hierarchy(self):
+        datadir = join(self.test_dir, 'hieradata')
+        os.makedirs(join(datadir, 'role'))
+        for (path, content) in [('common.yaml', "contact: ops\nrole: none\nkostenstelle: 1"),
+                                ('role/foobar.yaml', "contact: foo\nbackup: daily"),
+                                ('stage01.yaml', "kostenstelle: 2")]:
+            with open(join(datadir, path), 'w') as f:
+                f.write(content)
+        inputdir = join(self.test_dir, 'hosts')
+        os.mkdir(inputdir)
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'foobar'),
+                                   ('hostname03.stage02.invalid', 'mailserver')], inputdir)
+        self.genders_creator.inputdirectories = {'TestDir': inputdir}
+        self.genders_creator.hierarchy = ['role/%{role}', 'stage%{::stage}', 'common']
+        self.genders_creator.hieradata = datadir
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile) as f:
+            self.assertEqual(f.read().split('\n'), [
+                'hostname01.stage01.invalid\tbackup=daily,contact=foo,hostgroup=hostname,'
+                'kostenstelle=2,role=foobar,source=TestDir,stage=01',
+                'hostname02.stage02.invalid\tbackup=daily,contact=foo,hostgroup=hostname,'
+                'kostenstelle=1,role=foobar,source=TestDir,stage=02',
+                'hostname03.stage02.invalid\tcontact=ops,hostgroup=hostname,kostenstelle=1,'
+                'role=mailserver,source=TestDir,stage=02'])
+        self.assertEqual(self.genders_creator.stats.counters['layers_parsed'], 3)
+        self.assertEqual(self.genders_creator.stats.counters['layer_merges'], 3)
+        self.assertEqual(self.genders_creator.stats.counters['files_parsed'], 3)
+        self.assertEqual(self.genders_creator.stats.counters['files_deduplicated'], 1)
+        self.assertNotIn('layers_deduplicated', self.genders_creator.stats.counters)
+
+    def test_cache_fingerprint_depends_on_hierarchy(self):
+        datadir = join(self.test_dir, 'hieradata')
+        os.mkdir(datadir)
+        fingerprint = self.genders_creator.get_cache_fingerprint()
+        self.genders_creator.hierarchy = ['common']
+        self.genders_creator.hieradata = datadir
+        with_hierarchy = self.genders_creator.get_cache_fingerprint()
+        self.assertNotEqual(with_hierarchy, fingerprint)
+        with open(join(datadir, 'common.yaml'), 'w') as f:
+            f.write("contact: ops")
+        self.assertEqual(self.genders_creator.get_cache_fingerprint(), with_hierarchy)
+
+    def test_cache_checks_the_layers_of_every_host(self):
+        datadir = join(self.test_dir, 'hieradata')
+        inputdir = join(datadir, 'nodes')
+        os.makedirs(join(datadir, 'role'))
+        os.mkdir(inputdir)
+        with open(join(datadir, 'role', 'foobar.yaml'), 'w') as f:
+            f.write("contact: foo")
+        self.write_role_hostfiles([('hostname01.invalid', 'foobar'),
+                                   ('hostname02.invalid', 'foobar'),
+                                   ('hostname03.invalid', 'mailserver')], inputdir)
+        self.genders_creator.inputdirectories = {'TestDir': inputdir}
+        self.genders_creator.hierarchy = ['role/%{role}', 'common']
+        self.genders_creator.hieradata = datadir
+        self.genders_creator.cache = True
+        self.genders_creator.generate_genders_file()
+        with open(join(inputdir, 'hostname01.invalid.yaml'), 'w') as f:
+            f.write("role: foobar\nbackup: daily")
+        self.genders_creator.generate_genders_file()
+        self.assertEqual(self.genders_creator.stats.counters['cache_hits'], 2)
+        with open(join(datadir, 'role', 'foobar.yaml'), 'w') as f:
+            f.write("contact: foobar")
+        self.genders_creator.generate_genders_file()
+        self.assertEqual(self.genders_creator.stats.counters['cache_hits'], 1)
+        with open(join(datadir, 'common.yaml'), 'w') as f:
+            f.write("kostenstelle: 1")
+        self.genders_creator.generate_genders_file()
+        self.assertEqual(self.genders_creator.stats.counters['cache_hits'], 0)
+        with open(self.gendersfile) as f:
+            self.assertEqual(f.read().split('\n'), [
+                'hostname01.invalid\tbackup=daily,contact=foobar,kostenstelle=1,role=foobar,'
+                'source=TestDir',
+                'hostname02.invalid\tcontact=foobar,kostenstelle=1,role=foobar,source=TestDir',
+                'hostname03.invalid\tkostenstelle=1,role=mailserver,source=TestDir'])
+
+    def test_generate_genders_file_with_profile(self):
+        for (hostname, size) in [('hostname01.stage01.invalid', 1),
+                                 ('hostname02.stage02.invalid', 100)]:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("packages: [%s]" % ", ".join(["package"] * size))
+        self.genders_creator.profile = join(self.test_dir, 'profile.pstats')
+        self.genders_creator.generate_genders_file()
+        self.assertTrue(os.path.getsize(join(self.test_dir, 'profile.pstats')) > 0)
+        hosts = sorted(self.genders_creator.stats.hosts)
+        self.assertEqual([(host[0], host[2]) for host in hosts],
+                         [('hostname01.stage01.invalid', 19),
+                          ('hostname02.stage02.invalid', 910)])
+        report = self.genders_creator.stats.get_host_report(1).split('\n')
+        self.assertEqual(len(report), 4)
+        for phase in ['hostname_parsing', 'yaml_loading', 'rendering']:
+            self.assertIn(phase, self.genders_creator.stats.phases)
+        self.assertTrue(report[3].endswith("910  hostname02.stage02.invalid (%s)" % join(
+            self.test_dir, 'hostname02.stage02.invalid.yaml')))
+
+    def test_generate_genders_file_writes_targets(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('web02.stage02.invalid', 'mailserver')])
+        self.genders_creator.targets = [
+            GendersTarget(join(self.test_dir, 'genders.numbers'),
+                          {'invalid': r'^[a-z]+(?P<number>[0-9]+)\.'}),
+            GendersTarget.from_config({'gendersfile': join(self.test_dir, 'genders.web'),
+                                       'hosts': ['web*']}),
+        ]
+        expected = {
+            'gendersfile': [
+                'hostname01.stage01.invalid\thostgroup=hostname,role=foobar,source=TestDir,'
+                'stage=01',
+                'web02.stage02.invalid\thostgroup=web,role=mailserver,source=TestDir,stage=02'],
+            'genders.numbers': [
+                'hostname01.stage01.invalid\tnumber=01,role=foobar,source=TestDir',
+                'web02.stage02.invalid\tnumber=02,role=mailserver,source=TestDir'],
+            'genders.web': ['web02.stage02.invalid\trole=mailserver,source=TestDir'],
+        }
+        for (jobs, cache, sort_buffer_size) in [(1, None, None), (2, True, 1)]:
+            self.genders_creator.jobs = jobs
+            self.genders_creator.cache = cache
+            self.genders_creator.sort_buffer_size = sort_buffer_size
+            self.genders_creator.generate_genders_file()
+            self.assertEqual(self.genders_creator.stats.counters['files_parsed'], 2)
+            for (filename, lines) in expected.items():
+                with open(join(self.test_dir, filename)) as f:
+                    self.assertEqual(f.read().split('\n'), lines)
+
+    def test_identical_hostfiles_are_parsed_once(self):
+        self.write_role_hostfiles([('hostname01.stage01.invalid', 'foobar'),
+                                   ('hostname02.stage02.invalid', 'foobar'),
+                                   ('hostname03.stage02.invalid', 'mailserver')])
+        self.genders_creator.generate_genders_file()
+        with open(self.gendersfile) as f:
+            self.assertEqual([line.split('\t')[1] for line in f.read().split('\n')], [
+                'hostgroup=hostname,role=foobar,source=TestDir,stage=01',
+                'hostgroup=hostname,role=foobar,source=TestDir,stage=02',
+                'hostgroup=hostname,role=mailserver,source=TestDir,stage=02'])
+        self.assertEqual(self.genders_creator.stats.counters['files_parsed'], 3)
+        self.assertEqual(self.genders_creator.stats.counters['files_deduplicated'], 1)
+        self.assertAlmostEqual(self.genders_creator.stats.as_dict()['dedup_ratio'], 1 / 3.0)
+        config = self.genders_creator.get_config_from_file(
+            join(self.test_dir, 'hostname01.stage01.invalid.yaml'))
+        self.assertIs(config, self.genders_creator.get_config_from_file(
+            join(self.test_dir, 'hostname02.stage02.invalid.yaml')))
+        with self.assertRaises(TypeError):
+            config['role'] = 'changed'
+        with self.assertRaises(TypeError):
+            config.update(role='changed')
+        self.assertEqual(config, {'role': 'foobar'})
+        self.assertEqual(copy.deepcopy(config), {'role': 'foobar'})
+
+    def test_get_host_record_with_projection(self):
+        generator = GenerateGenders({"TestDir": self.test_dir}, self.gendersfile, {},
+                                    yaml_backend='python', exclude_attributes=['comment'],
+                                    max_depth=0)
+        with open(join(self.test_dir, 'host01.yaml'), 'w') as f:
+            f.write("role: web\ncomment: huge\npackages: [vim]")
+        with open(join(self.test_dir, 'host02.json'), 'w') as f:
+            f.write('{"role": "db", "comment": "huge", "packages": ["vim"]}')
+        generator.log.setLevel(logging.CRITICAL)
+        self.assertEqual(sorted(generator.get_gender_entries()),
+                         [u'host01\trole=web,source=TestDir',
+                          u'host02\trole=db,source=TestDir'])
+
+    def test_generate_genders_file_writes_index_database(self):
+        for (hostname, role) in [('hostname01.stage01.invalid', 'foobar'),
+                                 ('hostname02.stage02.invalid', 'foobar'),
+                                 ('hostname03.stage02.invalid', 'mailserver')]:
+            with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+                f.write("role: %s\nbackup: ~" % role)
+        database = join(self.test_dir, 'genders.db')
+        self.genders_creator.index_output = database
+        self.genders_creator.generate_genders_file()
+        connection = sqlite3.connect(database)
+        try:
+            self.assertEqual(
+                connection.execute("SELECT hostname FROM genders WHERE attribute = 'role' "
+                                   "AND value = 'foobar' ORDER BY hostname").fetchall(),
+                [('hostname01.stage01.invalid',), ('hostname02.stage02.invalid',)])
+            self.assertEqual(
+                connection.execute("SELECT hostname || '\t' || attributes FROM hosts "
+                                   "ORDER BY id").fetchall(),
+                [(line,) for line in open(self.gendersfile).read().split('\n')])
+        finally:
+            connection.close()
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['genders.db', 'gendersfile', 'hostname01.stage01.invalid.yaml',
+                          'hostname02.stage02.invalid.yaml', 'hostname03.stage02.invalid.yaml'])
+
+    def test_generate_genders_file_keeps_unchanged_index_database(self):
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: foobar")
+        database = join(self.test_dir, 'genders.db')
+        self.genders_creator.index_output = database
+        self.genders_creator.generate_genders_file()
+        os.utime(database, (0, 0))
+        self.genders_creator.generate_genders_file()
+        self.assertEqual(os.stat(database).st_mtime, 0)
+        with open(join(self.test_dir, 'hostname01.stage01.invalid.yaml'), 'w') as f:
+            f.write("role: mailserver")
+        self.genders_creator.generate_genders_file()
+        self.assertNotEqual(os.stat(database).st_mtime, 0)
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['genders.db', 'gendersfile', 'hostname01.stage01.invalid.yaml'])
+
+
+class TestGendersWatcher(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.gendersfile = join(self.test_dir, 'gendersfile')
+        self.genders_creator = GenerateGenders(
+            inputdirectories={"TestDir": self.test_dir},
+            domainconfig={},
+            gendersfile=self.gendersfile,
+            verbosity='CRITICAL'
+        )
+        self.write_hostfile('host01.invalid')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_hostfile(self, hostname):
+        with open(join(self.test_dir, hostname + '.yaml'), 'w') as f:
+            f.write("role: foobar")
+
+    def wait_for_gendersfile(self, content):
+        for _ in range(100):
+            try:
+                with open(self.gendersfile, 'r') as f:
+                    if f.read() == content:
+                        return
+            except IOError:
+                pass
+            time.sleep(0.05)
+        self.fail("Gendersfile not written")
+
+    @patch('generate_hostlist.pyinotify', None)
+    def test_wait_for_change_by_polling(self):
+        watcher = GendersWatcher(self.genders_creator, debounce=0, poll_interval=0)
+        self.assertTrue(self.genders_creator.cache)
+        watcher.snapshot = watcher.get_snapshot()
+        self.assertFalse(watcher.wait_for_change(0))
+        self.write_hostfile('host02.invalid')
+        self.assertTrue(watcher.wait_for_change(0))
+        self.assertFalse(watcher.wait_for_change(0))
+        self.assertNotIn('files_scanned', self.genders_creator.stats.counters)
+
+    @patch('generate_hostlist.pyinotify', None)
+    def test_run_regenerates_on_change(self):
+        watcher = GendersWatcher(self.genders_creator, debounce=0.05, poll_interval=0.05)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            self.wait_for_gendersfile("host01.invalid\trole=foobar,source=TestDir")
+            with patch('generate_hostlist.GenerateGenders.get_config_from_file') as mock_file_config:
+                mock_file_config.return_value = {'role': 'foobar'}
+                self.write_hostfile('host02.invalid')
+                self.wait_for_gendersfile("host01.invalid\trole=foobar,source=TestDir\n"
+                                          "host02.invalid\trole=foobar,source=TestDir")
+                mock_file_config.assert_called_once_with(join(self.test_dir, 'host02.invalid.yaml'))
+        finally:
+            watcher.stop()
+            thread.join()